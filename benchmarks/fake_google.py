@@ -0,0 +1,135 @@
+"""An in-process stand-in for the Calendar API service object, with simulated request latency, for benchmarking
+google_calendar.sync_events without a network or credentials"""
+import json, random, threading, time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+
+class Request:
+    def __init__(self, service, respond):
+        self.service = service
+        self.respond = respond
+
+    def execute(self, **kwargs):
+        with self.service.lock:
+            self.service.active += 1
+            self.service.most_active = max(self.service.most_active, self.service.active)
+        time.sleep(self.service.latency)
+        with self.service.lock:
+            self.service.active -= 1
+            self.service.requests += 1
+        return self.respond()
+
+
+def http_error(status: int, message: str):
+    from googleapiclient.errors import HttpError
+    from httplib2 import Response
+
+    return HttpError(Response({"status": status}), json.dumps({"error": {"code": status, "message": message}}).encode())
+
+
+def page(items, page_token, max_results, last_page):
+    """Slices one page out of items, ending with last_page's keys"""
+    first = int(page_token or 0)
+    result = {"items": items[first : first + max_results]}
+    if first + max_results < len(items):
+        result["nextPageToken"] = str(first + max_results)
+    else:
+        result.update(last_page)
+    return result
+
+
+class FakeEventsResource:
+    def __init__(self, service):
+        self.service = service
+
+    def list(self, calendarId, pageToken=None, syncToken=None, maxResults=250, **kwargs):
+        calendar = self.service.calendars[calendarId]
+
+        def respond():
+            if calendarId in self.service.missing:
+                raise http_error(404, "Not Found")
+            if syncToken is None:
+                items = calendar["events"]
+            elif syncToken == calendar["token"]:
+                items = []
+            elif syncToken in calendar["changes"]:
+                items = calendar["changes"][syncToken]
+            else:
+                raise http_error(410, "Sync token is no longer valid")
+            return page(items, pageToken, maxResults, {"nextSyncToken": calendar["token"]})
+
+        return Request(self.service, respond)
+
+
+class FakeCalendarListResource:
+    def __init__(self, service):
+        self.service = service
+
+    def list(self, pageToken=None, maxResults=100, **kwargs):
+        items = [
+            {"id": id, "summary": f"Calendar {id}", "timeZone": "UTC", "selected": True} for id in self.service.calendars
+        ]
+        return Request(self.service, lambda: page(items, pageToken, maxResults, {}))
+
+
+class FakeService:
+    """Holds calendars events resources with a sync token each. change() edits some events and hands out a new
+    token, so the next sync is incremental. Tokens it didn't hand out are answered with 410 Gone"""
+
+    def __init__(self, calendars: int, events: int, latency: float = 0.05, seed: int = 0):
+        self.latency = latency
+        self.requests = 0
+        # Requests being executed at once, now and at most
+        self.active = 0
+        self.most_active = 0
+        # Calendars whose events are answered with 404 Not Found
+        self.missing = set()
+        self.lock = threading.Lock()
+        self.rng = random.Random(seed)
+        now = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+
+        self.calendars = {}
+        for c in range(calendars):
+            items = []
+            for i in range(events):
+                start = now + timedelta(hours=self.rng.randint(-24 * 365, 24 * 365))
+                items.append(
+                    {
+                        "id": f"c{c}e{i}",
+                        "status": "confirmed",
+                        "summary": f"Event {i}",
+                        "start": {"dateTime": start.isoformat()},
+                        "end": {"dateTime": (start + timedelta(hours=1)).isoformat()},
+                    }
+                )
+            self.calendars[f"calendar{c}@fake"] = {"events": items, "changes": {}, "token": "0"}
+
+    def change(self, count: int):
+        """Renames count events of every calendar and cancels one"""
+        for calendar in self.calendars.values():
+            token = calendar["token"]
+            changed = []
+            for item in self.rng.sample(calendar["events"], count):
+                item["summary"] += " (moved)"
+                changed.append(item)
+            changed.append({"id": calendar["events"][0]["id"], "status": "cancelled"})
+            calendar["changes"][token] = changed
+            calendar["token"] = str(int(token) + 1)
+
+    def events(self):
+        return FakeEventsResource(self)
+
+    def calendarList(self):
+        return FakeCalendarListResource(self)
+
+
+class FakeSession:
+    """Hands out the same FakeService in place of google_calendar.Session"""
+
+    def __init__(self, service: FakeService):
+        self._service = service
+
+    @contextmanager
+    def service(self):
+        yield self._service
@@ -0,0 +1,117 @@
+"""Generates cal.db files filled with synthetic calendars and events. The same size and seed always give the same
+database, and an existing file with the right number of events is reused"""
+import os, random, sqlite3
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+import db
+from cal import Calendar, Calendars, Event, Events, Recurrence
+
+# Named sizes for the command line
+SIZES = {"1k": 1_000, "100k": 100_000, "1M": 1_000_000}
+
+TIME_ZONES = ["Australia/Melbourne", "Europe/London", "America/New_York", "Asia/Tokyo", "America/Los_Angeles", "UTC"]
+NAMES = ["Standup", "1:1", "Lunch", "Planning", "Review", "Gym", "Dentist", "Flight", "Retro", "Interview"]
+
+# Events are spread over this many days either side of now
+SPREAD_DAYS = 2 * 365
+
+# Events written per transaction while generating
+BATCH = 50_000
+
+
+def calendar_ids(calendars: int) -> list[str]:
+    return [f"calendar{i}@bench" for i in range(calendars)]
+
+
+def random_event(rng: random.Random, id: str, calendar_id: str, now: datetime) -> Event:
+    """Mostly timed events in a spread of time zones, with some all day and multi day events"""
+    day = (now + timedelta(days=rng.randint(-SPREAD_DAYS, SPREAD_DAYS))).date()
+    kind = rng.random()
+
+    if kind < 0.1:
+        start = day
+        end = day + timedelta(1)
+    elif kind < 0.15:
+        start = day
+        end = day + timedelta(rng.randint(2, 14))
+    else:
+        zone = ZoneInfo(rng.choice(TIME_ZONES))
+        local = datetime.combine(day, datetime.min.time(), tzinfo=zone) + timedelta(minutes=15 * rng.randint(28, 76))
+        start = local.astimezone(timezone.utc)
+        end = start + timedelta(minutes=rng.choice([15, 30, 30, 60, 60, 90, 120]))
+
+    description = f"Description of {id}" if rng.random() < 0.2 else None
+    return Event(id=id, calendar_id=calendar_id, start=start, end=end, name=rng.choice(NAMES), description=description)
+
+
+def generate(path: str, events: int, calendars: int = 20, seed: int = 0) -> str:
+    """Writes a database of events events spread over calendars calendars to path, with one weekly recurring
+    event per calendar, and points db at it. Returns path"""
+    db.close()
+    db.DB_PATH = path
+
+    if os.path.exists(path):
+        con = sqlite3.connect(path)
+        try:
+            count = con.execute("SELECT count(*) FROM events WHERE recurrence_id IS NULL").fetchone()[0]
+        except sqlite3.OperationalError:
+            count = None
+        con.close()
+        if count == events:
+            return path
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    ids = calendar_ids(calendars)
+
+    Calendars(
+        {
+            id: Calendar(id=id, name=f"Calendar {i}", time_zone=TIME_ZONES[i % len(TIME_ZONES)], active=i % 4 != 3)
+            for i, id in enumerate(ids)
+        }
+    ).write()
+
+    for first in range(0, events, BATCH):
+        batch = {}
+        for i in range(first, min(first + BATCH, events)):
+            event = random_event(rng, f"event{i}", rng.choice(ids), now)
+            batch[event.id] = event
+        Events(batch).write()
+
+    import recurrence
+
+    recurrences = {}
+    for i, id in enumerate(ids):
+        zone = ZoneInfo(TIME_ZONES[i % len(TIME_ZONES)])
+        start = datetime.combine(now.date() - timedelta(365), datetime.min.time(), tzinfo=zone) + timedelta(hours=9)
+        recurrences[f"weekly{i}"] = Recurrence(
+            id=f"weekly{i}",
+            calendar_id=id,
+            start=start,
+            end=start + timedelta(minutes=30),
+            name="Weekly sync",
+            description=None,
+            time_zone=zone.key,
+            rules=("RRULE:FREQ=WEEKLY;BYDAY=MO",),
+        )
+    recurrence.write(recurrences)
+
+    db.connect().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    return path
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Generate a synthetic cal.db")
+    parser.add_argument("path")
+    parser.add_argument("--size", choices=SIZES, default="1k")
+    parser.add_argument("--calendars", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    generate(args.path, SIZES[args.size], args.calendars, args.seed)
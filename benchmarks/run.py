@@ -0,0 +1,203 @@
+"""Times the hot paths against generated databases and writes the results as JSON, so runs can be compared.
+
+    python -m benchmarks.run --sizes 1k 100k --output results.json
+"""
+import argparse, contextlib, io, json, os, platform, shutil, sqlite3, statistics, subprocess, sys, tempfile, time
+from datetime import datetime, timedelta, timezone
+
+import db
+import check_db
+from cal import Calendars, Events
+from snapshot import write_snapshot
+from benchmarks.generate import SIZES, generate
+from benchmarks.fake_google import FakeService, FakeSession
+
+TZ_NAME = "Australia/Melbourne"
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+
+def measure(function, repeat: int, setup=None) -> list[float]:
+    """Seconds taken by each of repeat calls of function, running setup untimed before each"""
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def result(name: str, size: str, times: list[float], **extra) -> dict:
+    return {
+        "name": name,
+        "size": size,
+        "runs": len(times),
+        "min": min(times),
+        "median": statistics.median(times),
+        "max": max(times),
+        **extra,
+    }
+
+
+def use(path: str):
+    """Points db at path with fresh connections"""
+    db.close()
+    db.DB_PATH = path
+
+
+def bench_database(path: str, size: str, repeat: int) -> list[dict]:
+    results = []
+    now = datetime.now(timezone.utc)
+    window = (now, now + timedelta(30))
+
+    def run(name, function, setup=None, **extra):
+        results.append(result(name, size, measure(function, repeat, setup), **extra))
+
+    def fresh_snapshot():
+        con = db.connect()
+        with con:
+            write_snapshot(con)
+
+    def no_snapshot():
+        con = db.connect()
+        with con:
+            con.execute("DELETE FROM snapshot")
+
+    def quiet_main():
+        with contextlib.redirect_stdout(io.StringIO()):
+            check_db.main([])
+
+    run("check_db.main", quiet_main, fresh_snapshot)
+    run("check_db.main without snapshot", quiet_main, no_snapshot)
+
+    # Includes interpreter startup and imports, as waybar sees it
+    env = {**os.environ, "WAYBAR_CALENDAR_DB": path}
+    command = [sys.executable, "check_db.py"]
+    run(
+        "check_db process",
+        lambda: subprocess.run(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, check=True),
+        fresh_snapshot,
+    )
+
+    run("Events() all", lambda: Events())
+    run("Events(window) 30 days", lambda: Events(window=window))
+    run("Events(window, limit=10)", lambda: Events(window=window, limit=10))
+
+    year = Events(window=(now, now + timedelta(365)))
+    for interval in ("day", "week", "month"):
+        run(f"Events.group {interval}, 1 year", lambda: year.group(TZ_NAME, interval), events=len(year))
+
+    # Write in the same shape a sync does: a batch of synced events, some changed. Instances expanded from recurrences
+    # are left out, as a sync never writes them and Events.write would replace them the first time
+    synced = {
+        id
+        for id, in db.connect(readonly=True).execute(
+            "SELECT id FROM events WHERE recurrence_id IS NULL ORDER BY start_utc LIMIT 1000"
+        )
+    }
+    batch = {id: event for id, event in Events().items() if id in synced}
+    changed = {}
+
+    def change_batch():
+        changed.clear()
+        for id, event in batch.items():
+            changed[id] = event._replace(name=event.name + "!")
+        batch.update(changed)
+
+    run(f"Events.write {len(batch)} unchanged", lambda: Events(batch).write())
+    run(f"Events.write {len(batch)} changed", lambda: Events(changed).write(), change_batch)
+
+    calendars = Calendars()
+
+    def toggle_calendar():
+        first = next(iter(calendars))
+        calendars[first] = calendars[first]._replace(active=not calendars[first].active)
+
+    run("Calendars.write unchanged", lambda: Calendars(dict(calendars)).write())
+    run("Calendars.write one toggled", lambda: calendars.write(), toggle_calendar)
+
+    return results
+
+
+def bench_sync(directory: str, repeat: int, calendars: int, events: int, latency: float) -> list[dict]:
+    import google_calendar
+
+    results = []
+    size = f"{calendars}x{events}"
+    service = FakeService(calendars, events, latency)
+    session = FakeSession(service)
+    runs = []
+
+    def empty_database():
+        # A new file each time, since cal only migrates each path once per process
+        runs.append(len(runs))
+        use(os.path.join(directory, f"sync{len(runs)}.db"))
+        google_calendar.sync_calendars(session)
+        service.requests = 0
+
+    def sync():
+        with contextlib.redirect_stdout(io.StringIO()):
+            google_calendar.sync_events(Calendars(), session=session)
+
+    times = measure(sync, repeat, empty_database)
+    results.append(result("sync_events full", size, times, latency=latency, requests=service.requests))
+
+    service.requests = 0
+    times = measure(sync, repeat, lambda: service.change(10))
+    results.append(result("sync_events incremental", size, times, latency=latency, requests=service.requests))
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark waybar-calendar")
+    parser.add_argument("--sizes", nargs="+", choices=SIZES, default=["1k", "100k"])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument(
+        "--cache", default=os.path.join(tempfile.gettempdir(), "waybar-calendar-bench"), help="where databases are kept"
+    )
+    parser.add_argument("--sync-calendars", type=int, default=8)
+    parser.add_argument("--sync-events", type=int, default=2000)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds each fake API request takes")
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.cache, exist_ok=True)
+    results = []
+
+    for size in args.sizes:
+        generated = generate(os.path.join(args.cache, f"{size}.db"), SIZES[size])
+        # The timed writes change the database, so they run on a copy and the generated one can be reused
+        path = os.path.join(args.cache, f"{size}-run.db")
+        db.close()
+        shutil.copyfile(generated, path)
+        for suffix in ("-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        use(path)
+
+        print(f"Benchmarking {size} events", file=sys.stderr)
+        results += bench_database(path, size, args.repeat)
+
+    with tempfile.TemporaryDirectory() as directory:
+        print("Benchmarking sync_events", file=sys.stderr)
+        results += bench_sync(directory, args.repeat, args.sync_calendars, args.sync_events, args.latency)
+        db.close()
+
+    report = {
+        "time": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    for row in results:
+        print(f"{row['name']:<40} {row['size']:>8} {row['median'] * 1000:>10.2f} ms", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
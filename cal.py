@@ -1,12 +1,14 @@
-import os, sqlite3
+import sqlite3, calendar, hashlib, sys
 from collections.abc import MutableMapping
-from collections import defaultdict
+from itertools import islice
 from datetime import datetime, date
 import pytz
-from typing import NamedTuple, Optional, Union
+from typing import Iterable, NamedTuple, Optional, Union
 
-dir_path = os.path.dirname(os.path.realpath(__file__))
-DB_PATH = f"{dir_path}/cal.db"
+import db, profiling
+from intervals import in_progress
+from snapshot import write_snapshot
+from timezones import DAY, get_localizer
 
 
 def cal_factory(cursor, row):
@@ -36,6 +38,297 @@ sqlite3.register_adapter(date, adapt_datetime)
 sqlite3.register_converter("bool", convert_bool)
 
 
+def to_epoch(obj: Union[datetime, date]) -> int:
+    """Seconds since the epoch in UTC. Dates (all day events) and naive datetimes are taken as UTC"""
+    if type(obj) is datetime:
+        if obj.tzinfo is None:
+            obj = obj.replace(tzinfo=pytz.utc)
+        return int(obj.timestamp())
+    else:
+        return calendar.timegm(obj.timetuple())
+
+
+def _create_tables(con):
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS calendars (id TEXT PRIMARY KEY NOT NULL, name TEXT, description TEXT, time_zone TEXT, active INTEGER, UNIQUE(id));"
+    )
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS events (id TEXT PRIMARY KEY NOT NULL, calendar_id TEXT, start TEXT, end TEXT, name TEXT, description TEXT, UNIQUE(id));"
+    )
+
+
+def _add_epoch_columns(con):
+    """start and end are ISO text mixing dates and offset datetimes, which can't be compared or indexed usefully.
+    start_utc and end_utc hold the same times as integer epochs"""
+    con.execute("ALTER TABLE events ADD COLUMN start_utc INTEGER")
+    con.execute("ALTER TABLE events ADD COLUMN end_utc INTEGER")
+    con.execute("ALTER TABLE events ADD COLUMN all_day INTEGER")
+
+    rows = con.execute("SELECT id, start, end FROM events").fetchall()
+    updates = []
+    for id, start, end in rows:
+        start = convert_datetime(start.encode())
+        end = convert_datetime(end.encode())
+        updates.append((to_epoch(start), to_epoch(end), type(start) is not datetime, id))
+    con.executemany("UPDATE events SET start_utc = ?, end_utc = ?, all_day = ? WHERE id = ?", updates)
+
+    con.execute("CREATE INDEX events_start_utc ON events (start_utc)")
+    con.execute("CREATE INDEX events_calendar_start_utc ON events (calendar_id, start_utc)")
+
+
+def _add_keyset_index(con):
+    """Lets Events.iter_window page through (start_utc, id) without sorting. Replaces the (start_utc) index"""
+    con.execute("CREATE INDEX events_start_utc_id ON events (start_utc, id)")
+    con.execute("DROP INDEX events_start_utc")
+
+
+def _create_sync_state(con):
+    """Google Calendar sync tokens, so each sync only asks for what changed since the last one"""
+    con.execute(
+        "CREATE TABLE sync_state (calendar_id TEXT PRIMARY KEY NOT NULL, sync_token TEXT, synced_at INTEGER)"
+    )
+
+
+def _add_hash_column(con):
+    """A hash of each event's content, so writes can skip rows that haven't changed"""
+    con.execute("ALTER TABLE events ADD COLUMN hash INTEGER")
+
+    rows = con.execute("SELECT id, calendar_id, start, end, name, description FROM events").fetchall()
+    con.executemany("UPDATE events SET hash = ? WHERE id = ?", [(row_hash(row), row[0]) for row in rows])
+
+
+def _create_recurrences(con):
+    """Recurring events are stored once, with their rules, and expanded into events rows on demand.
+    recurrence_exceptions holds the original start of instances that were moved or cancelled, and expansions the
+    range each recurrence has been expanded over. Sync tokens are cleared because they were issued for lists with
+    every instance expanded by Google"""
+    con.execute("ALTER TABLE events ADD COLUMN recurrence_id TEXT")
+    con.execute("CREATE INDEX events_recurrence_id ON events (recurrence_id) WHERE recurrence_id IS NOT NULL")
+    con.execute(
+        "CREATE TABLE recurrences (id TEXT PRIMARY KEY NOT NULL, calendar_id TEXT, start TEXT, end TEXT, name TEXT, description TEXT, time_zone TEXT, rules TEXT, start_utc INTEGER, last_utc INTEGER, hash INTEGER)"
+    )
+    con.execute(
+        "CREATE TABLE recurrence_exceptions (recurrence_id TEXT NOT NULL, start_utc INTEGER NOT NULL, PRIMARY KEY (recurrence_id, start_utc))"
+    )
+    con.execute(
+        "CREATE TABLE expansions (recurrence_id TEXT PRIMARY KEY NOT NULL, start_utc INTEGER, end_utc INTEGER, hash INTEGER)"
+    )
+    con.execute("UPDATE sync_state SET sync_token = NULL")
+
+
+def _add_rtree(con):
+    """An R*Tree over [start_utc, end_utc] of every event, keyed by the events rowid and kept in step by triggers, so
+    overlap queries don't scan end_utc. Its 32 bit float bounds are rounded outwards, so queries check the exact
+    epochs afterwards. SQLite builds without R*Tree support go without it.
+    events has a TEXT primary key, so its rowids are implicit and VACUUM may renumber them, see rebuild_indexes"""
+    try:
+        con.execute("CREATE VIRTUAL TABLE events_rtree USING rtree(id, start_utc, end_utc)")
+    except sqlite3.OperationalError as e:
+        print(f"Not indexing event times with an R*Tree: {e}", file=sys.stderr)
+        return
+
+    # An R*Tree box can't end before it starts
+    con.execute(
+        """CREATE TRIGGER events_rtree_insert AFTER INSERT ON events BEGIN
+        INSERT INTO events_rtree VALUES (new.rowid, new.start_utc, max(new.start_utc, new.end_utc));
+        END"""
+    )
+    con.execute(
+        """CREATE TRIGGER events_rtree_update AFTER UPDATE OF start_utc, end_utc ON events BEGIN
+        UPDATE events_rtree SET start_utc = new.start_utc, end_utc = max(new.start_utc, new.end_utc)
+        WHERE id = old.rowid;
+        END"""
+    )
+    con.execute(
+        """CREATE TRIGGER events_rtree_delete AFTER DELETE ON events BEGIN
+        DELETE FROM events_rtree WHERE id = old.rowid;
+        END"""
+    )
+    con.execute(
+        "INSERT INTO events_rtree SELECT rowid, start_utc, max(start_utc, end_utc) FROM events WHERE start_utc IS NOT NULL"
+    )
+
+
+def _add_search_index(con):
+    """An FTS5 index over the name and description of every event, reading its text from the events table and kept
+    in step by triggers, so searches don't scan the table. SQLite builds without FTS5 fall back to LIKE.
+    Like events_rtree it is keyed by the implicit events rowid, see rebuild_indexes"""
+    try:
+        con.execute(
+            "CREATE VIRTUAL TABLE events_fts USING fts5(name, description, content='events', content_rowid='rowid', tokenize='unicode61 remove_diacritics 2')"
+        )
+    except sqlite3.OperationalError as e:
+        print(f"Not indexing event text with FTS5: {e}", file=sys.stderr)
+        return
+
+    # An external content index is told the old text to remove with the special 'delete' insert
+    con.execute(
+        """CREATE TRIGGER events_fts_insert AFTER INSERT ON events BEGIN
+        INSERT INTO events_fts (rowid, name, description) VALUES (new.rowid, new.name, new.description);
+        END"""
+    )
+    con.execute(
+        """CREATE TRIGGER events_fts_update AFTER UPDATE OF name, description ON events BEGIN
+        INSERT INTO events_fts (events_fts, rowid, name, description) VALUES ('delete', old.rowid, old.name, old.description);
+        INSERT INTO events_fts (rowid, name, description) VALUES (new.rowid, new.name, new.description);
+        END"""
+    )
+    con.execute(
+        """CREATE TRIGGER events_fts_delete AFTER DELETE ON events BEGIN
+        INSERT INTO events_fts (events_fts, rowid, name, description) VALUES ('delete', old.rowid, old.name, old.description);
+        END"""
+    )
+    con.execute("INSERT INTO events_fts (events_fts) VALUES ('rebuild')")
+
+
+def _create_change_log(con):
+    """change_log gets the id of every event and calendar that is inserted, updated or deleted, filled in by
+    triggers so no write path can miss it. Readers keep the last seq they saw and read only what changed since, see
+    change_log.py. Only the last 10000 changes are kept"""
+    con.execute(
+        "CREATE TABLE change_log (seq INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, id TEXT NOT NULL)"
+    )
+    con.execute(
+        """CREATE TRIGGER change_log_prune AFTER INSERT ON change_log BEGIN
+        DELETE FROM change_log WHERE seq <= new.seq - 10000;
+        END"""
+    )
+    for table, kind in (("events", "event"), ("calendars", "calendar")):
+        for action, row in (("INSERT", "new"), ("UPDATE", "new"), ("DELETE", "old")):
+            con.execute(
+                f"""CREATE TRIGGER {table}_change_log_{action.lower()} AFTER {action} ON {table} BEGIN
+                INSERT INTO change_log (kind, id) VALUES ('{kind}', {row}.id);
+                END"""
+            )
+
+
+# Each migration moves the database up one version, stored in PRAGMA user_version. Only ever append to this list
+MIGRATIONS = [
+    _create_tables,
+    _add_epoch_columns,
+    _add_keyset_index,
+    _create_sync_state,
+    _add_hash_column,
+    _create_recurrences,
+    _add_rtree,
+    _add_search_index,
+    _create_change_log,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+_migrated = set()
+
+# Rows read per query by Events.iter_window
+ITER_BATCH = 100
+
+# Results returned by Events.search unless a limit is given
+SEARCH_LIMIT = 50
+
+
+def row_hash(row) -> int:
+    """A signed 64 bit hash of a row such as (id, calendar_id, start, end, name, description), ignoring the id"""
+    content = "\x1f".join("" if value is None else str(value) for value in row[1:])
+    return int.from_bytes(hashlib.blake2b(content.encode(), digest_size=8).digest(), "big", signed=True)
+
+
+def search_terms(text: str) -> list[str]:
+    """Splits what was typed into a search box into words, each matched as a prefix"""
+    return text.split()
+
+
+def match_query(terms: list[str]) -> str:
+    """An FTS5 query matching rows with every one of terms as a prefix. Terms are quoted, so characters such as - or
+    : are searched for rather than read as FTS5 syntax"""
+    return " ".join('"{}"*'.format(term.replace('"', '""')) for term in terms)
+
+
+def like_pattern(term: str) -> str:
+    """A LIKE pattern, escaped with \\, matching text containing term"""
+    return "%{}%".format(term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_"))
+
+
+def chunks(items: list, size: int = 500):
+    """Splits items into lists short enough to bind as sqlite3 parameters"""
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+def event_row(event) -> tuple:
+    """The columns of an events row: the Event fields with times as ISO text, then start_utc, end_utc, all_day
+    and hash"""
+    row = tuple(adapt_datetime(value) if isinstance(value, date) else value for value in event)
+    return (*row, to_epoch(event.start), to_epoch(event.end), type(event.start) is not datetime, row_hash(row))
+
+
+class WriteResult(NamedTuple):
+    """Number of rows affected by a write"""
+
+    inserted: int = 0
+    updated: int = 0
+    deleted: int = 0
+    unchanged: int = 0
+
+
+def rebuild_indexes(con):
+    """Rebuilds events_rtree and events_fts from the events table. Both are keyed by the implicit events rowid, which
+    VACUUM is free to renumber, so this has to run straight after any VACUUM of cal.db"""
+    tables = {row[0] for row in con.execute("SELECT name FROM sqlite_master WHERE name IN ('events_rtree', 'events_fts')")}
+    if "events_rtree" in tables:
+        con.execute("DELETE FROM events_rtree")
+        con.execute(
+            "INSERT INTO events_rtree SELECT rowid, start_utc, max(start_utc, end_utc) FROM events WHERE start_utc IS NOT NULL"
+        )
+    if "events_fts" in tables:
+        con.execute("INSERT INTO events_fts (events_fts) VALUES ('rebuild')")
+
+
+def schema_version(con):
+    return con.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(con):
+    """Brings the database up to SCHEMA_VERSION, applying each outstanding migration in its own transaction"""
+    for i in range(schema_version(con), SCHEMA_VERSION):
+        with con:
+            # Take the write lock before checking again, in case another process is migrating too
+            con.execute("BEGIN IMMEDIATE")
+            if schema_version(con) != i:
+                continue
+            MIGRATIONS[i](con)
+            con.execute(f"PRAGMA user_version = {i + 1}")
+
+
+def connect(readonly: bool = False):
+    """Returns this thread's shared connection from db.connect, migrating the database the first time this process
+    uses it. Readers get a read-only connection and only open a writable one if the schema is out of date"""
+    con = db.connect(readonly)
+    if db.DB_PATH not in _migrated:
+        if schema_version(con) < SCHEMA_VERSION:
+            with profiling.span("migrate"):
+                migrate(db.connect())
+        _migrated.add(db.DB_PATH)
+
+    return con
+
+
+def read_sync_tokens() -> dict[str, str]:
+    """Returns the stored sync token of each calendar that has one"""
+    cur = connect(readonly=True).execute("SELECT calendar_id, sync_token FROM sync_state WHERE sync_token IS NOT NULL")
+    return dict(cur.fetchall())
+
+
+def write_sync_tokens(tokens: dict[str, Optional[str]]):
+    """Stores the sync token of each calendar. A token of None forces a full sync next time"""
+    con = connect()
+    now = int(datetime.now(pytz.utc).timestamp())
+
+    with con:
+        con.executemany(
+            "INSERT OR REPLACE INTO sync_state (calendar_id, sync_token, synced_at) VALUES (?, ?, ?)",
+            [(calendar_id, token, now) for calendar_id, token in tokens.items()],
+        )
+
+
 class Event(NamedTuple):
     """Class for Event information.
     Attributes mirror the columns of sqlite3 table events"""
@@ -49,11 +342,7 @@ class Event(NamedTuple):
     description: Optional[str] = None
 
     def localize(self, obj: Union[datetime, date], tz_name):
-        if type(obj) is datetime:
-            tz = pytz.timezone(tz_name)
-            return obj.astimezone(tz)
-        else:
-            return obj
+        return get_localizer(tz_name).local(obj)
 
     def local_start(self, tz_name):
         return self.localize(self.start, tz_name)
@@ -62,6 +351,22 @@ class Event(NamedTuple):
         return self.localize(self.end, tz_name)
 
 
+class Recurrence(NamedTuple):
+    """Class for a recurring event, before it is expanded into Event instances.
+    Attributes mirror the columns of sqlite3 table recurrences"""
+
+    id: str
+    calendar_id: str
+    # The first instance, in time_zone so the rules expand across daylight saving changes
+    start: Union[datetime, date]
+    end: Union[datetime, date]
+    name: str
+    description: Optional[str]
+    time_zone: str
+    # RRULE, RDATE, EXRULE and EXDATE lines as they appear in iCalendar
+    rules: tuple[str, ...]
+
+
 CALENDAR_DOWNLOADED_INFO = ("name", "description", "time_zone")
 CALENDAR_PROGRAM_INFO = ("id", "active")
 
@@ -82,37 +387,41 @@ class Calendar(NamedTuple):
 
 
 class GroupedObject(MutableMapping):
-    """A collection of objects intended to be inherited by Calendars and Events"""
+    """A collection of objects intended to be inherited by Calendars and Events.
+    Items are kept in their own dict, so ids can't collide with attribute names"""
+
+    __slots__ = ("_items",)
 
     def __init__(self, *args, **kwargs):
-        """Use the object dict"""
-        self.__dict__.update(*args, **kwargs)
+        self._items = dict(*args, **kwargs)
 
     def __getitem__(self, key):
-        return self.__dict__[key]
+        return self._items[key]
 
     def __delitem__(self, key):
-        del self.__dict__[key]
+        del self._items[key]
 
     def __setitem__(self, key, value):
-        self.__dict__[key] = value
+        self._items[key] = value
 
     def __iter__(self):
-        return iter(self.__dict__)
+        return iter(self._items)
 
     def __len__(self):
-        return len(self.__dict__)
+        return len(self._items)
 
     def __repr__(self):
-        return "{}, GroupedObject({})".format(super(GroupedObject, self).__repr__(), self.__dict__)
+        return "{}, GroupedObject({})".format(super(GroupedObject, self).__repr__(), self._items)
 
     def __str__(self):
-        return f"[{', '.join([str(cal) for cal in self.__dict__])}]"
+        return f"[{', '.join([str(cal) for cal in self._items])}]"
 
 
 class Calendars(GroupedObject):
     """A collection of Calendar objects with methods for sqlite3"""
 
+    __slots__ = ()
+
     def __init__(self, calendars: dict[str, Calendar] = None):
         read_calendars = self._read()
         if calendars is not None:
@@ -120,10 +429,10 @@ class Calendars(GroupedObject):
         else:
             calendars = read_calendars
 
-        super().__init__(**calendars)
+        super().__init__(calendars)
 
     def __repr__(self):
-        return f"Calendars([{', '.join([repr(cal) for cal in self.__dict__])}])"
+        return f"Calendars([{', '.join([repr(cal) for cal in self._items])}])"
 
     def resolve_calendars(self, c1: dict[str, Calendar], c2: dict[str, Calendar]):
         """Overrides downloaded information in c1 with any information in c2 and returns completed c1"""
@@ -135,39 +444,50 @@ class Calendars(GroupedObject):
                 for elem in CALENDAR_PROGRAM_INFO:
                     attrs[elem] = getattr(c1[id], elem)
                 c1[id] = Calendar(**attrs)
-            c1[id] = calendar
+            else:
+                c1[id] = calendar
 
         return c1
 
     def active(self):
-        return {key: value for key, value in self.__dict__.items() if value.active}
+        return {key: value for key, value in self._items.items() if value.active}
 
-    def write(self):
-        """write all calendars to sqlite3 database"""
-        con = sqlite3.connect(DB_PATH)
-        con.execute(
-            "CREATE TABLE IF NOT EXISTS calendars (id TEXT PRIMARY KEY NOT NULL, name TEXT, description TEXT, time_zone TEXT, active INTEGER, UNIQUE(id));"
-        )
+    @profiling.timed("Calendars.write")
+    def write(self) -> WriteResult:
+        """write the calendars that differ from the sqlite3 database"""
+        con = connect()
 
         with con:
+            # Take the write lock before comparing, so another writer can't change the rows in between
+            con.execute("BEGIN IMMEDIATE")
+            stored = {row[0]: row for row in con.execute("SELECT id, name, description, time_zone, active FROM calendars")}
+            new = [cal for cal in self._items.values() if cal.id not in stored]
+            changed = [cal for cal in self._items.values() if cal.id in stored and stored[cal.id] != tuple(cal)]
+
             con.executemany(
                 "INSERT OR REPLACE INTO calendars (id, name, description, time_zone, active) VALUES (?, ?, ?, ?, ?)",
-                self.__dict__.values(),
+                new + changed,
             )
 
+            # Active calendars may have changed, so the upcoming events will have too
+            if new or changed:
+                write_snapshot(con)
+
+        return WriteResult(inserted=len(new), updated=len(changed), unchanged=len(self) - len(new) - len(changed))
+
+    @profiling.timed("Calendars._read")
     def _read(self):
         """read all calendars from sqlite3 database"""
-        con = sqlite3.connect(DB_PATH, detect_types=sqlite3.PARSE_COLNAMES)
+        cur = connect(readonly=True).cursor()
 
         # Each row of the calendars table is constructed as a Calendar object through cal_factory
-        con.row_factory = cal_factory
+        cur.row_factory = cal_factory
 
-        with con:
-            results = list(
-                con.execute(
-                    "SELECT id, name, description, time_zone AS 'time_zone [timezone]', active AS 'active [bool]' FROM calendars;"
-                )
+        results = list(
+            cur.execute(
+                "SELECT id, name, description, time_zone AS 'time_zone [timezone]', active AS 'active [bool]' FROM calendars;"
             )
+        )
 
         results_dict = {cal.id: cal for cal in results}
 
@@ -177,42 +497,40 @@ class Calendars(GroupedObject):
         cal_ids = {cal.id: i for i, cal in enumerate(self._calendars)}
 
         for event in events:
-            self.__dict__[cal_ids[event.cal_id]].events.append(event)
+            self._items[cal_ids[event.cal_id]].events.append(event)
 
 
 class Events(GroupedObject):
-    """A collection of Event objects with methods for sqlite3"""
+    """A collection of Event objects with methods for sqlite3. For large numbers of events see
+    event_store.EventStore, which holds the same data in compact columns"""
+
+    __slots__ = ()
 
     def __init__(
-        self, events: dict[str, Event] = None, window: Union[tuple[datetime, datetime], None] = None, limit: int = 0
+        self,
+        events: dict[str, Event] = None,
+        window: Union[tuple[datetime, datetime], None] = None,
+        limit: int = 0,
+        overlapping: bool = False,
     ):
         if events is None:
-            events = self._read(window, limit)
-        super().__init__(**events)
+            events = self._read(window, limit, overlapping)
+        super().__init__(events)
 
     def __repr__(self):
-        return f"Events([{', '.join([repr(cal) for cal in self.__dict__])}])"
-
-    def _read(self, window: Union[tuple[datetime, datetime], None] = None, limit: int = 0):
-        con = sqlite3.connect(DB_PATH, detect_types=sqlite3.PARSE_COLNAMES)
-
-        con.row_factory = lambda x, y: Event(*y)
-
-        vars = ["id", "calendar_id", "start AS 'start [datetime]'", "end AS 'end [datetime]'"]
-        if window is None:
-            vars += ["name", "description"]
+        return f"Events([{', '.join([repr(cal) for cal in self._items])}])"
 
-            join = ""
-            where = ""
-        else:
-            vars.pop(0)
-            vars.insert(0, "events.id")
-            vars += ["events.name", "events.description"]
+    @profiling.timed("Events._read")
+    def _read(self, window: Union[tuple[datetime, datetime], None] = None, limit: int = 0, overlapping: bool = False):
+        if window is not None:
+            events = self.iter_window(window[0], window[1], batch=limit or ITER_BATCH, overlapping=overlapping)
+            if limit:
+                events = islice(events, limit)
+            return {event.id: event for event in events}
 
-            join = "INNER JOIN calendars ON events.calendar_id = calendars.id"
-            where = "WHERE start BETWEEN ? and ? AND active = 1"
+        cur = connect(readonly=True).cursor()
 
-        order_by = "ORDER BY start"
+        cur.row_factory = lambda x, y: Event(*y)
 
         if not limit:
             limit_str = ""
@@ -220,47 +538,244 @@ class Events(GroupedObject):
             limit_str = f"LIMIT {limit}"
 
         query = f"""SELECT 
-        {", ".join(vars)}
+        id, calendar_id, start AS 'start [datetime]', end AS 'end [datetime]', name, description
         FROM events
-        {join}
-        {where}
-        {order_by}
+        ORDER BY start_utc
         {limit_str}
         """
 
-        with con:
-            if window is None:
-                results = list(con.execute(query))
-            else:
-                results = list(con.execute(query, (window[0], window[1])))
+        results = list(cur.execute(query))
+        profiling.count("event rows read", len(results))
 
         results_dict = {event.id: event for event in results}
 
         return results_dict
 
-    def write(self):
-        """write all events to sqlite3 database"""
-        con = sqlite3.connect(DB_PATH)
-        con.execute(
-            "CREATE TABLE IF NOT EXISTS events (id TEXT PRIMARY KEY NOT NULL, calendar_id TEXT, start TEXT, end TEXT, name TEXT, description TEXT, UNIQUE(id));"
-        )
+    @staticmethod
+    def iter_window(
+        start: datetime,
+        end: datetime,
+        calendars: Optional[list[str]] = None,
+        batch: int = ITER_BATCH,
+        overlapping: bool = False,
+    ):
+        """Yields Event objects starting between start and end in order of start, reading batch rows at a time.
+        Pages through the (start_utc, id) index, so stopping early never reads more than one batch past the
+        last event used. With overlapping, the events that started before start and are still going at start come
+        first, found through events_rtree, see intervals.in_progress. Events of active calendars are returned unless
+        calendars gives the calendar ids. Recurring events are expanded over the window first, if they haven't been
+        already"""
+        from recurrence import ensure_expanded
+
+        # Recurring instances still going at start began at most a day or so earlier
+        ensure_expanded(to_epoch(start) - DAY if overlapping else to_epoch(start), to_epoch(end))
+
+        con = connect(readonly=True)
+        cur = con.cursor()
+
+        # The last two columns are the keyset for the next page
+        cur.row_factory = lambda x, y: (Event(*y[:6]), y[6])
+
+        if calendars is None:
+            join = "INNER JOIN calendars ON events.calendar_id = calendars.id"
+            where = "active = 1"
+            params = {}
+        else:
+            join = ""
+            where = f"calendar_id IN ({', '.join(f':calendar{i}' for i in range(len(calendars)))})"
+            params = {f"calendar{i}": id for i, id in enumerate(calendars)}
+
+        select = f"""SELECT 
+        events.id, calendar_id, start AS 'start [datetime]', end AS 'end [datetime]', events.name, events.description, start_utc
+        FROM events
+        {join}
+        """
+
+        if overlapping:
+            # Everything in progress started before anything in the window
+            with profiling.span("Events.iter_window in progress"):
+                rows = cur.execute(
+                    f"{select} WHERE {in_progress(con)} AND {where} ORDER BY start_utc, events.id",
+                    {"at": to_epoch(start), **params},
+                ).fetchall()
+            profiling.count("event rows read", len(rows))
+            for event, _ in rows:
+                yield event
+
+        query = f"""{select}
+        WHERE (start_utc, events.id) > (:start, :id) AND start_utc <= :end AND {where}
+        ORDER BY start_utc, events.id
+        LIMIT :limit
+        """
+
+        # Every id sorts after "", so the first page includes events starting exactly at start
+        last = (to_epoch(start), "")
+        end_utc = to_epoch(end)
+        while True:
+            with profiling.span("Events.iter_window page"):
+                rows = cur.execute(
+                    query, {"start": last[0], "id": last[1], "end": end_utc, "limit": batch, **params}
+                ).fetchall()
+            profiling.count("event rows read", len(rows))
+            for event, _ in rows:
+                yield event
+
+            if len(rows) < batch:
+                break
+            event, start_utc = rows[-1]
+            last = (start_utc, event.id)
+
+    @classmethod
+    @profiling.timed("Events.search")
+    def search(
+        cls,
+        query: str,
+        window: Union[tuple[datetime, datetime], None] = None,
+        limit: int = SEARCH_LIMIT,
+        calendars: Optional[list[str]] = None,
+    ) -> "Events":
+        """Events whose name or description contains every word of query, as whole words or their beginnings, best
+        matches first. Matches in the name count for more than in the description, and equal matches are ordered by
+        how close they are to now. Only events starting in window are searched if it is given, after expanding
+        recurring events over it. Recurring events appear once, as their instance closest to now. Searches events of
+        active calendars unless calendars gives the calendar ids"""
+        terms = search_terms(query)
+        if not terms:
+            return cls({})
+
+        if window is not None:
+            from recurrence import ensure_expanded
+
+            ensure_expanded(to_epoch(window[0]), to_epoch(window[1]))
+
+        con = connect(readonly=True)
+        cur = con.cursor()
+        cur.row_factory = lambda x, y: (Event(*y[:6]), y[6])
+
+        params = {"now": to_epoch(datetime.now(pytz.utc))}
+        conditions = []
+        if con.execute("SELECT 1 FROM sqlite_master WHERE name = 'events_fts'").fetchone() is not None:
+            source = "events_fts INNER JOIN events ON events.rowid = events_fts.rowid"
+            conditions.append("events_fts MATCH :match")
+            params["match"] = match_query(terms)
+            order = "bm25(events_fts, 10.0, 1.0), "
+        else:
+            source = "events"
+            for i, term in enumerate(terms):
+                conditions.append(
+                    f"(events.name LIKE :term{i} ESCAPE '\\' OR events.description LIKE :term{i} ESCAPE '\\')"
+                )
+                params[f"term{i}"] = like_pattern(term)
+            order = ""
+
+        if calendars is None:
+            source += " INNER JOIN calendars ON events.calendar_id = calendars.id"
+            conditions.append("active = 1")
+        else:
+            conditions.append(f"calendar_id IN ({', '.join(f':calendar{i}' for i in range(len(calendars)))})")
+            params.update({f"calendar{i}": id for i, id in enumerate(calendars)})
+
+        if window is not None:
+            conditions.append("start_utc BETWEEN :start AND :end")
+            params.update(start=to_epoch(window[0]), end=to_epoch(window[1]))
+
+        query = f"""SELECT
+        events.id, calendar_id, start AS 'start [datetime]', end AS 'end [datetime]', events.name, events.description, recurrence_id
+        FROM {source}
+        WHERE {' AND '.join(conditions)}
+        ORDER BY {order}abs(start_utc - :now)
+        """
+
+        results = {}
+        seen = set()
+        for event, recurrence_id in cur.execute(query, params):
+            if recurrence_id is not None:
+                if recurrence_id in seen:
+                    continue
+                seen.add(recurrence_id)
+            results[event.id] = event
+            if len(results) == limit:
+                break
+        profiling.count("search results", len(results))
+
+        return cls(results)
+
+    @profiling.timed("Events.write")
+    def write(
+        self,
+        deleted: Iterable[str] = (),
+        replace_calendars: Iterable[str] = (),
+        window: Union[tuple[datetime, datetime], None] = None,
+    ) -> WriteResult:
+        """write the events that differ from the sqlite3 database, comparing content hashes, and delete the events
+        with ids in deleted. Events of replace_calendars (starting in window, if given) that are not in this
+        collection are deleted too, for writing the result of a full sync. Everything happens in one transaction"""
+        con = connect()
+
+        rows = {event.id: event_row(event) for event in self._items.values()}
 
         with con:
+            # Take the write lock before comparing, so another writer can't insert the same ids in between
+            con.execute("BEGIN IMMEDIATE")
+            stored = {}
+            for ids in chunks(list(rows)):
+                # Instances expanded from a recurrence have no hash here, so a synced event with the same id
+                # always replaces them
+                stored.update(
+                    con.execute(
+                        f"SELECT id, CASE WHEN recurrence_id IS NULL THEN hash END FROM events WHERE id IN ({', '.join('?' * len(ids))})",
+                        ids,
+                    )
+                )
+
+            new = [row for id, row in rows.items() if id not in stored]
+            changed = [row[1:] + row[:1] for id, row in rows.items() if id in stored and stored[id] != row[-1]]
+
+            con.executemany(
+                "INSERT INTO events (id, calendar_id, start, end, name, description, start_utc, end_utc, all_day, hash) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                new,
+            )
             con.executemany(
-                "INSERT OR REPLACE INTO events (id, calendar_id, start, end, name, description) VALUES (?, ?, ?, ?, ?, ?)",
-                self.__dict__.values(),
+                "UPDATE events SET calendar_id = ?, start = ?, end = ?, name = ?, description = ?, start_utc = ?, end_utc = ?, all_day = ?, hash = ?, recurrence_id = NULL WHERE id = ?",
+                changed,
             )
 
+            # Expanded instances belong to their recurrence, which is replaced by recurrence.write
+            deleted = set(deleted) - rows.keys()
+            for calendar_id in replace_calendars:
+                if window is None:
+                    cur = con.execute(
+                        "SELECT id FROM events WHERE calendar_id = ? AND recurrence_id IS NULL", (calendar_id,)
+                    )
+                else:
+                    cur = con.execute(
+                        "SELECT id FROM events WHERE calendar_id = ? AND recurrence_id IS NULL AND start_utc BETWEEN ? AND ?",
+                        (calendar_id, to_epoch(window[0]), to_epoch(window[1])),
+                    )
+                deleted.update(id for id, in cur if id not in rows)
+
+            # rowcount leaves out the rows changed by triggers, unlike con.total_changes
+            deleted_count = con.executemany("DELETE FROM events WHERE id = ?", ((id,) for id in deleted)).rowcount
+
+            if new or changed or deleted_count:
+                write_snapshot(con)
+
+        return WriteResult(
+            inserted=len(new),
+            updated=len(changed),
+            deleted=deleted_count,
+            unchanged=len(rows) - len(new) - len(changed),
+        )
+
+    @profiling.timed("Events.group")
     def group(self, TZ_NAME, interval: Union[str, None] = None):
-        """Takes a str interval as a strftime format code
-        Returns a dictionary of lists of Event, split by the result of the format code"""
+        """Takes a str interval of "day", "week" or "month", or a strftime format code.
+        Returns a dictionary of lists of Event, split by the local date each interval starts on, or by the result
+        of the format code"""
         if interval is None:
-            interval = "%Y-%m-%d"
-        split = defaultdict(list)
-        for event in self.__dict__.values():
-            split[event.local_start(TZ_NAME).strftime(interval)].append(event)
+            interval = "day"
 
-        return split
+        return get_localizer(TZ_NAME).group(self._items.values(), interval)
 
 
 if __name__ == "__main__":
@@ -1,17 +1,47 @@
-import sys, importlib
-from datetime import datetime, timedelta
+import sys, importlib, threading, traceback
+from datetime import datetime, timedelta, timezone
+from itertools import islice
 
 import gi
 
 gi.require_version("Gtk", "3.0")
-from gi.repository import Gtk, Gio, GLib
+from gi.repository import Gtk, Gio, GLib, GObject
 
-from cal import Calendar, Calendars, Event, Events
+import db
+from cal import Calendar, Calendars, Event, Events, to_epoch
+from change_log import ChangeTracker
+from event_store import EventStore
+from timezones import get_localizer
 
 google_calendar = importlib.import_module("google_calendar", "waybar-calendar")
 
 TZ_NAME = "Australia/Melbourne"
 
+# Search results shown below the search box
+SEARCH_RESULTS = 20
+
+# Events read from the database at a time as the agenda is scrolled
+AGENDA_PAGE = 50
+# How far ahead the agenda goes
+AGENDA_DAYS = 365
+# The next page is read once the agenda is scrolled within this many pixels of its end
+AGENDA_PRELOAD = 300
+
+# How long the outcome of a sync is shown for
+SYNC_MESSAGE_SECONDS = 5
+
+# Milliseconds to wait after cal.db changes on disk before looking for what changed, as one commit touches it
+# several times
+CHANGE_DELAY = 100
+
+
+def day_label(day):
+    if 4 <= day.day % 100 <= 20:
+        day_tag = "th"
+    else:
+        day_tag = {1: "st", 2: "nd", 3: "rd"}.get(day.day % 10, "th")
+    return f"{day:%A}, {day:%-d}{day_tag} of {day:%B}"
+
 
 class DialogCal(Gtk.Dialog):
     def __init__(self, parent, calendars):
@@ -60,6 +90,185 @@ class DialogCal(Gtk.Dialog):
         listbox.set_sort_func(sort_func, None, False)
 
 
+class AgendaItem(GObject.Object):
+    """An Event in the agenda's Gio.ListStore, which can only hold GObjects"""
+
+    def __init__(self, event: Event, happening: bool = False):
+        super().__init__()
+        self.event = event
+        self.happening = happening
+        # The order of the agenda, which is the order Events.iter_window reads in
+        self.key = (to_epoch(event.start), event.id)
+
+
+def compare_items(item_1, item_2):
+    return (item_1.key > item_2.key) - (item_1.key < item_2.key)
+
+
+class Agenda(Gtk.ScrolledWindow):
+    """The events under way and then the upcoming ones. Events are read AGENDA_PAGE at a time as the list is
+    scrolled towards its end, so rows are only built for what has been read, and day headers are added by the list
+    box as it lays out rows. apply() patches in changes to the database without reading the rest again"""
+
+    def __init__(self, tz_name):
+        super().__init__(hscrollbar_policy=Gtk.PolicyType.NEVER)
+        self.set_min_content_height(400)
+        self.set_propagate_natural_width(True)
+
+        self.tz_name = tz_name
+        self.localizer = get_localizer(tz_name)
+        self.store = Gio.ListStore(item_type=AgendaItem)
+        self._pages = None
+        self._loading = False
+        # The agenda starts at _start, and every event up to the key _loaded_until has been read
+        self._start = None
+        self._loaded_until = None
+
+        listbox = Gtk.ListBox()
+        listbox.set_selection_mode(Gtk.SelectionMode.NONE)
+        listbox.bind_model(self.store, self.create_row)
+        listbox.set_header_func(self.update_header)
+        self.add(listbox)
+
+        # "changed" is emitted when rows are added, so a list too short to scroll keeps reading pages until it fills
+        # the window
+        adjustment = self.get_vadjustment()
+        adjustment.connect("changed", self.on_scrolled)
+        adjustment.connect("value-changed", self.on_scrolled)
+
+    def reload(self):
+        """Starts again from now"""
+        self.store.remove_all()
+        self._pages = self.pages()
+        self.load_more()
+
+    def pages(self):
+        """Yields lists of AgendaItem, first of the events under way and then of the events starting after now, in
+        order of start"""
+        start = self._start = datetime.now(timezone.utc)
+        end = start + timedelta(AGENDA_DAYS)
+        self._loaded_until = (to_epoch(start), "")
+        in_progress = EventStore.read(start, start, overlapping=True)
+        happening = set(in_progress.active_at(start, self.tz_name).ids)
+        yield [AgendaItem(event, event.id in happening) for event in in_progress]
+
+        # Events starting exactly now are in both
+        shown = set(in_progress.ids)
+        events = Events.iter_window(start, end, batch=AGENDA_PAGE)
+        while True:
+            page = list(islice(events, AGENDA_PAGE))
+            if not page:
+                self._loaded_until = (to_epoch(end) + 1, "")
+                return
+            # iter_window carries on after the last event it yielded
+            self._loaded_until = (to_epoch(page[-1].start), page[-1].id)
+            yield [AgendaItem(event) for event in page if event.id not in shown]
+
+    def apply(self, changes):
+        """Patches in a change_log.Changes. Rows of the changed events, and of the events of changed calendars, are
+        removed and whichever of them are still in the part of the agenda already read are read again and put back
+        in order. Events further on are left for iter_window to read as the agenda is scrolled"""
+        if self._loaded_until is None or not (changes.events or changes.calendars):
+            return
+        if not changes.complete:
+            self.reload()
+            return
+
+        stores = []
+        if changes.events:
+            stores.append(EventStore.read_ids(changes.events))
+        if changes.calendars:
+            calendars = Calendars()
+            active = [id for id in changes.calendars if id in calendars and calendars[id].active]
+            if active:
+                until = datetime.fromtimestamp(self._loaded_until[0], timezone.utc)
+                stores.append(EventStore.read(self._start, until, calendars=active, overlapping=True))
+
+        for i in reversed(range(self.store.get_n_items())):
+            event = self.store.get_item(i).event
+            if event.id in changes.events or event.calendar_id in changes.calendars:
+                self.store.remove(i)
+
+        now = datetime.now(timezone.utc)
+        start_utc = to_epoch(self._start)
+        added = set()
+        for store in stores:
+            happening = set(store.active_at(now, self.tz_name).ids)
+            for i, id in enumerate(store.ids):
+                # Events that ended before the agenda starts aren't in it
+                if (store.starts[i], id) > self._loaded_until or store.ends[i] <= start_utc or id in added:
+                    continue
+                added.add(id)
+                self.store.insert_sorted(AgendaItem(store.event(i), id in happening), compare_items)
+
+    def load_more(self):
+        """Reads the next page once the main loop is idle, so the window is drawn before anything is read"""
+        if self._pages is None or self._loading:
+            return
+        self._loading = True
+        GLib.idle_add(self._load_page)
+
+    def _load_page(self):
+        self._loading = False
+        page = next(self._pages, None)
+        while page is not None and not page:
+            page = next(self._pages, None)
+
+        if page is None:
+            self._pages = None
+        else:
+            # One items-changed signal for the whole page
+            self.store.splice(self.store.get_n_items(), 0, page)
+        return GLib.SOURCE_REMOVE
+
+    def on_scrolled(self, adjustment):
+        if adjustment.get_value() + adjustment.get_page_size() >= adjustment.get_upper() - AGENDA_PRELOAD:
+            self.load_more()
+
+    def day(self, item):
+        start = self.localizer.local(item.event.start)
+        return start.date() if type(start) is datetime else start
+
+    def update_header(self, row, before):
+        day = self.day(self.store.get_item(row.get_index()))
+        if before is not None and self.day(self.store.get_item(before.get_index())) == day:
+            row.set_header(None)
+            return
+
+        label = day_label(day)
+        header = row.get_header()
+        if header is None or header.get_label() != label:
+            header = Gtk.Label(label=label, xalign=0)
+            header.set_margin_top(6)
+            row.set_header(header)
+
+    def create_row(self, item):
+        event = item.event
+
+        box_event = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=1)
+        box_event.set_margin_start(10)
+        box_event.set_margin_end(10)
+
+        widgets = []
+        name = f"Now: {event.name}" if item.happening else event.name
+        widgets.append(Gtk.Label(label=name, xalign=0))
+        if type(event.start) is datetime:
+            widgets.append(
+                Gtk.Label(
+                    label=f"{self.localizer.local(event.start):%H:%M} - {self.localizer.local(event.end):%H:%M}",
+                    xalign=1,
+                )
+            )
+        if event.description is not None:
+            widgets.append(Gtk.Label(label=event.description, xalign=0))
+
+        for widget in widgets:
+            box_event.pack_start(widget, True, True, 0)
+
+        box_event.show_all()
+        return box_event
+
+
 class MyWindow(Gtk.Window):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -72,52 +281,33 @@ class MyWindow(Gtk.Window):
         box_outer = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=6)
         self.add(box_outer)
 
-        start = datetime.utcnow()
-        end = start + timedelta(150)
-        events = Events(window=(start, end), limit=10)
-
-        blurb = Gtk.Label(label="Upcoming events:", xalign=0)
-        box_outer.pack_start(blurb, True, True, 0)
-
-        for group, events in events.group(TZ_NAME).items():
-            dt = events[0].local_start(TZ_NAME)
-            if 4 <= dt.day % 100 <= 20:
-                day_tag = "th"
-            else:
-                day_tag = {1: "st", 2: "nd", 3: "rd"}.get(dt.day % 10, "th")
-            group_label = f"{dt:%A}, {dt:%-d}{day_tag} of {dt:%B}"
-            frame = Gtk.Frame(label=group_label)
-            frame.set_shadow_type(Gtk.ShadowType.ETCHED_IN)
-            box_event_group = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=3)
-
-            # widgets_group.append(Gtk.Label(label=group, xalign=0))
-
-            for event in events:
-
-                box_event = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=1)
-                box_event.set_margin_start(10)
-                box_event.set_margin_end(10)
-
-                widgets = []
-                widgets.append(Gtk.Label(label=event.name, xalign=0))
-                # widgets.append(Gtk.Label(label=event.local_start(TZ_NAME).strftime("%Y-%m-%d"), xalign=0))
-                if type(event.start) is datetime:
-                    widgets.append(
-                        Gtk.Label(
-                            label=f"{event.local_start(TZ_NAME).strftime('%H:%M')} - {event.local_end(TZ_NAME).strftime('%H:%M')}",
-                            xalign=1,
-                        )
-                    )
-                if event.description is not None:
-                    widgets.append(Gtk.Label(label=event.description, xalign=0))
-
-                for widget in widgets:
-                    box_event.pack_start(widget, True, True, 0)
+        # search-changed waits for a pause in typing before it is emitted
+        search_entry = Gtk.SearchEntry(placeholder_text="Search events")
+        search_entry.connect("search-changed", self.on_search_changed)
+        box_outer.pack_start(search_entry, False, True, 0)
 
-                box_event_group.pack_start(box_event, True, True, 0)
+        # Hidden until there is something to show
+        self.search_results = Gtk.ListBox()
+        self.search_results.set_selection_mode(Gtk.SelectionMode.NONE)
+        self.search_results.set_no_show_all(True)
+        box_outer.pack_start(self.search_results, False, True, 0)
 
-            frame.add(box_event_group)
-            box_outer.pack_start(frame, True, True, 5)
+        blurb = Gtk.Label(label="Upcoming events:", xalign=0)
+        box_outer.pack_start(blurb, False, True, 0)
+
+        self.agenda = Agenda(TZ_NAME)
+        box_outer.pack_start(self.agenda, True, True, 0)
+        # Changes from before the agenda is read are patched in harmlessly
+        self.changes = ChangeTracker()
+        self.agenda.reload()
+
+        # Commits in WAL mode change cal.db-wal, and checkpoints cal.db. The monitors stop when they are freed
+        self._monitors = []
+        self._change_pending = False
+        for path in (db.DB_PATH, db.DB_PATH + "-wal"):
+            monitor = Gio.File.new_for_path(path).monitor_file(Gio.FileMonitorFlags.NONE, None)
+            monitor.connect("changed", self.on_db_changed)
+            self._monitors.append(monitor)
 
         box_buttons = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=3)
 
@@ -135,6 +325,75 @@ class MyWindow(Gtk.Window):
 
         box_outer.pack_start(box_buttons, True, True, 0)
 
+        self.sync_buttons = [button_sync_calendars, button_sync_events]
+        self._cancel = None
+
+        # Shown while a sync runs. no_show_all keeps the window's show_all from showing it, and stops show_all on it
+        # too, so its children are shown here and the box itself with show() and hide()
+        self.box_sync = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=3)
+        self.box_sync.set_no_show_all(True)
+        self.sync_progress = Gtk.ProgressBar(show_text=True)
+        self.sync_progress.set_valign(Gtk.Align.CENTER)
+        self.sync_progress.show()
+        self.box_sync.pack_start(self.sync_progress, True, True, 0)
+        self.button_cancel = Gtk.Button(label="Cancel")
+        self.button_cancel.connect("clicked", self.on_cancel_clicked)
+        self.button_cancel.show()
+        self.box_sync.pack_start(self.button_cancel, False, True, 0)
+        box_outer.pack_start(self.box_sync, False, True, 0)
+
+        self.connect("destroy", self.on_destroy)
+
+    def on_db_changed(self, monitor, file, other_file, event_type):
+        if not self._change_pending:
+            self._change_pending = True
+            GLib.timeout_add(CHANGE_DELAY, self.check_changes)
+
+    def check_changes(self):
+        self._change_pending = False
+        changes = self.changes.poll()
+        if changes.calendars or not changes.complete:
+            self._calendars = Calendars()
+        self.agenda.apply(changes)
+        return GLib.SOURCE_REMOVE
+
+    def on_search_changed(self, entry):
+        for row in self.search_results.get_children():
+            self.search_results.remove(row)
+
+        text = entry.get_text()
+        if not text.strip():
+            self.search_results.hide()
+            return
+
+        events = Events.search(text, limit=SEARCH_RESULTS)
+        if not events:
+            label = Gtk.Label(label="No events found", xalign=0)
+            label.show()
+            self.search_results.add(label)
+
+        # Best matches first
+        localizer = get_localizer(TZ_NAME)
+        for event in events.values():
+            start = localizer.local(event.start)
+            if type(event.start) is datetime:
+                when = f"{start:%a %-d %b %Y %H:%M}"
+            else:
+                when = f"{start:%a %-d %b %Y}"
+
+            box_event = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=10)
+            box_event.set_margin_start(10)
+            box_event.set_margin_end(10)
+            box_event.pack_start(Gtk.Label(label=event.name, xalign=0), True, True, 0)
+            box_event.pack_start(Gtk.Label(label=when, xalign=1), True, True, 0)
+            if event.description is not None:
+                box_event.set_tooltip_text(event.description)
+            # show_all does nothing on the no_show_all list, so each row is shown as it is added
+            box_event.show_all()
+            self.search_results.add(box_event)
+
+        self.search_results.show()
+
     def on_configure_clicked(self, widget):
 
         dialog = DialogCal(self, self._calendars)
@@ -176,33 +435,77 @@ class MyWindow(Gtk.Window):
 
         listbox.set_sort_func(sort_func, None, False)"""
 
-    def on_sync_clicked(self, widget):
-        dialog = Gtk.MessageDialog(
-            transient_for=self,
-            flags=0,
-            message_type=Gtk.MessageType.INFO,
-            buttons=Gtk.ButtonsType.OK,
-            text="Completed Sync",
-        )
-
-        cals = google_calendar.sync_calendars()
+    def start_sync(self, text, sync):
+        """Runs sync(progress, cancel) on a worker thread, so the window stays responsive. GTK can only be used from
+        the main loop, so progress and the outcome are passed back with GLib.idle_add"""
+        self._cancel = threading.Event()
+        for button in self.sync_buttons:
+            button.set_sensitive(False)
+        self.button_cancel.set_sensitive(True)
+        self.sync_progress.set_fraction(0)
+        self.sync_progress.set_text(text)
+        self.box_sync.show()
+
+        def progress(update):
+            GLib.idle_add(self.on_sync_progress, update)
+
+        def run(cancel):
+            try:
+                sync(progress, cancel)
+            except google_calendar.SyncCancelled:
+                message = "Sync cancelled"
+            except Exception as e:
+                traceback.print_exc()
+                message = f"Sync failed: {e}"
+            else:
+                message = "Completed sync"
+            GLib.idle_add(self.on_sync_finished, message)
 
-        dialog.run()
-        dialog.destroy()
+        threading.Thread(target=run, args=(self._cancel,), daemon=True).start()
 
-    def on_sync_events_clicked(self, widget):
-        dialog = Gtk.MessageDialog(
-            transient_for=self,
-            flags=0,
-            message_type=Gtk.MessageType.INFO,
-            buttons=Gtk.ButtonsType.OK,
-            text="Completed Sync",
+    def on_sync_progress(self, update):
+        self.sync_progress.set_fraction(update.calendars_done / update.calendars)
+        self.sync_progress.set_text(
+            f"{update.calendars_done} of {update.calendars} calendars, {update.events} events fetched"
         )
+        return GLib.SOURCE_REMOVE
+
+    def on_sync_finished(self, message):
+        self._cancel = None
+        for button in self.sync_buttons:
+            button.set_sensitive(True)
+        self.button_cancel.set_sensitive(False)
+        self.sync_progress.set_text(message)
+
+        # What was synced is patched into the agenda by check_changes
+        GLib.timeout_add_seconds(SYNC_MESSAGE_SECONDS, self.hide_sync)
+        return GLib.SOURCE_REMOVE
+
+    def hide_sync(self):
+        # Unless another sync has started since
+        if self._cancel is None:
+            self.box_sync.hide()
+        return GLib.SOURCE_REMOVE
+
+    def on_cancel_clicked(self, widget):
+        if self._cancel is not None:
+            self._cancel.set()
+            self.button_cancel.set_sensitive(False)
+            self.sync_progress.set_text("Cancelling")
+
+    def on_destroy(self, widget):
+        if self._cancel is not None:
+            self._cancel.set()
 
-        events = google_calendar.sync_events(self._calendars)
+    def on_sync_clicked(self, widget):
+        self.start_sync("Syncing calendars", lambda progress, cancel: google_calendar.sync_calendars(cancel=cancel))
 
-        dialog.run()
-        dialog.destroy()
+    def on_sync_events_clicked(self, widget):
+        # Calendars are read again on the worker thread, which has its own connection
+        self.start_sync(
+            "Syncing events",
+            lambda progress, cancel: google_calendar.sync_events(Calendars(), progress=progress, cancel=cancel),
+        )
 
 
 class Application(Gtk.Application):
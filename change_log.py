@@ -0,0 +1,54 @@
+"""Tells a long running reader, such as the GTK app, what changed in cal.db since it last looked. PRAGMA data_version
+says whether any other connection has committed at all, which costs nothing to check, and only then is change_log
+read for the ids of the events and calendars that were inserted, updated or deleted"""
+from typing import NamedTuple
+
+from cal import connect
+
+
+class Changes(NamedTuple):
+    """Ids of what was inserted, updated or deleted since the last check"""
+
+    events: frozenset[str]
+    calendars: frozenset[str]
+    # False when changes were pruned from change_log before they were read, so everything needs reading again
+    complete: bool = True
+
+
+class ChangeTracker:
+    """Starts from the state of the database when it is created. Must be used from a single thread, since
+    PRAGMA data_version is kept per connection"""
+
+    def __init__(self):
+        con = connect(readonly=True)
+        self._data_version = self._read_data_version(con)
+        self._seq = con.execute("SELECT coalesce(max(seq), 0) FROM change_log").fetchone()[0]
+
+    @staticmethod
+    def _read_data_version(con) -> int:
+        return con.execute("PRAGMA data_version").fetchone()[0]
+
+    def poll(self) -> Changes:
+        """What has changed since the last poll, or since the tracker was created. Commits made on this thread's own
+        writable connection count too, as it is a different connection to the one read here"""
+        con = connect(readonly=True)
+        data_version = self._read_data_version(con)
+        if data_version == self._data_version:
+            return Changes(frozenset(), frozenset())
+        self._data_version = data_version
+
+        last = self._seq
+        events = set()
+        calendars = set()
+        first = None
+        for seq, kind, id in con.execute(
+            "SELECT seq, kind, id FROM change_log WHERE seq > :seq ORDER BY seq", {"seq": self._seq}
+        ):
+            if first is None:
+                first = seq
+            (events if kind == "event" else calendars).add(id)
+            self._seq = seq
+
+        # seq only goes up, so a gap after the last one read means changes were pruned unseen
+        complete = first is None or first <= last + 1
+        return Changes(frozenset(events), frozenset(calendars), complete)
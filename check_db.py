@@ -1,67 +1,228 @@
-from datetime import datetime, date, time, timedelta
-import sys, os, json, sqlite3
-
-import pytz
-
-from cal import Events, Event
+"""The waybar widget. Startup time is most of its cost, so this module only imports what it needs to ask server.py or
+read the snapshot: zoneinfo instead of pytz, and cal (with pytz and sqlite3 converters) only when neither can be
+used"""
+# Imported first, so the time spent on the rest of the imports can be reported
+import profiling
+from datetime import datetime, timedelta, timezone
+import os, sys, json
+import time as systime
+from zoneinfo import ZoneInfo
+
+import ipc
+from db import connect
+from intervals import IntervalIndex
+from snapshot import SNAPSHOT_SIZE, parse_datetime, read_snapshot
 
 SEARCH_DATE = "2021-06-29"
 
+# Seconds between checks in --follow mode
+FOLLOW_INTERVAL = 30
 
-def read_sqlite_datetime(datetimebyte):
-    return datetime.fromisoformat(datetimebyte.decode())
-
-
-sqlite3.register_converter("datetime", read_sqlite_datetime)
+# Kept open between checks in --follow mode
+_client = None
 
 
 def find_time_bound(local_tz, custom_search=False):
     if custom_search:
-        local_start = local_tz.localize(datetime.strptime(SEARCH_DATE, "%Y-%m-%d"))
+        local_start = datetime.strptime(SEARCH_DATE, "%Y-%m-%d").replace(tzinfo=local_tz)
     else:
-        local_start = local_tz.localize(datetime.combine(datetime.now().date(), datetime.min.time()))
-    start = local_start.astimezone(pytz.utc)
+        local_start = datetime.combine(datetime.now().date(), datetime.min.time(), tzinfo=local_tz)
+    start = local_start.astimezone(timezone.utc)
     end = start + timedelta(100)
 
     return start, end
 
 
-def main():
-    local_tz = pytz.timezone("Australia/Melbourne")
-    tz_name = "Australia/Melbourne"
-    start, end = find_time_bound(local_tz, custom_search=False)
-
-    data = Events(window=(start, end))
-
-    if len(data) == 1:
-        event = data[0]
-        info = {
-            "start": event.local_start(tz_name).strftime("%H:%M"),
-            "end": event.local_end(tz_name).strftime("%H:%M"),
-            "title": event.name,
-            "time_diff": int((event.start - start).total_seconds() / 60),
-        }
-
-        if info["time_diff"] > 60:
-            hours = int(info["time_diff"] / 60)
-            mins = int(info["time_diff"] - hours * 60)
-            if mins > 0:
-                mins_str = f" and {mins} minutes"
-            else:
-                mins_str = ""
-            upcoming = f"{hours} hours{mins_str}"
+def localize(obj, local_tz):
+    """All day events are stored as dates, which start at local midnight"""
+    if type(obj) is datetime:
+        return obj.astimezone(local_tz)
+    else:
+        return datetime.combine(obj, datetime.min.time(), tzinfo=local_tz)
+
+
+def read_events(start, end):
+    """Returns (id, calendar_id, start, end, name, description) rows for the events overlapping start to end,
+    as many as the snapshot holds"""
+    with profiling.span("read_snapshot"):
+        snapshot = read_snapshot(connect(readonly=True), start, end)
+    if snapshot is not None:
+        profiling.count("snapshot rows", len(snapshot))
+        return snapshot
+
+    with profiling.span("read events"):
+        with profiling.span("import event_store"):
+            from event_store import EventStore
+
+        rows = [tuple(event) for event in EventStore.read(start, end, limit=SNAPSHOT_SIZE, overlapping=True)]
+    profiling.count("event rows", len(rows))
+    return rows
+
+
+def parse_row(row):
+    id, calendar_id, start, end, name, description = row
+    return (id, calendar_id, parse_datetime(start), parse_datetime(end), name, description)
+
+
+def ask_server(tz_name, now):
+    """Returns the rows of the events happening now and the next event's row or None, from server.py. Returns None
+    when no server is running"""
+    global _client
+    if _client is None and not os.path.exists(ipc.socket_path()):
+        return None
+
+    try:
+        with profiling.span("ask server"):
+            if _client is None:
+                _client = ipc.Client()
+            result = _client.request("next", tz=tz_name, at=now.isoformat())
+    except (OSError, ValueError, ipc.ServerError):
+        if _client is not None:
+            _client.close()
+            _client = None
+        return None
+
+    current = [parse_row(row) for row in result["current"]]
+    return current, None if result["next"] is None else parse_row(result["next"])
+
+
+def read_current(tz_name, now):
+    """The same as ask_server, from the snapshot or the events table"""
+    local_tz = ZoneInfo(tz_name)
+    _, end = find_time_bound(local_tz, custom_search=False)
+
+    # Only what is under way now and what comes after is needed, and a busy morning could fill the rows read
+    data = read_events(now, end)
+    with profiling.span("index"):
+        index = IntervalIndex(
+            [(int(localize(row[2], local_tz).timestamp()), int(localize(row[3], local_tz).timestamp())) for row in data]
+        )
+
+        current = [data[i] for i in index.active_at(int(now.timestamp()))]
+        next_i = index.next_after(int(now.timestamp()))
+
+    return current, None if next_i is None else data[next_i]
+
+
+def minutes_text(minutes):
+    if minutes > 60:
+        hours = int(minutes / 60)
+        mins = int(minutes - hours * 60)
+        if mins > 0:
+            mins_str = f" and {mins} minutes"
         else:
-            upcoming = f"{int(info['time_diff'])} minutes"
+            mins_str = ""
+        return f"{hours} hours{mins_str}"
+    else:
+        return f"{int(minutes)} minutes"
+
+
+def widget(tz_name):
+    """Returns the waybar dict for the event happening now and the next one, or None if there is nothing to show.
+    All day events are only shown as the next event, not as happening now"""
+    local_tz = ZoneInfo(tz_name)
+    now = datetime.now(timezone.utc)
+
+    # One server can answer every widget and script, so the database is only read by it
+    events = ask_server(tz_name, now)
+    if events is None:
+        events = read_current(tz_name, now)
+    current, next_event = events
+    current = [row for row in current if type(row[2]) is datetime]
+
+    if current:
+        _, _, event_start, event_end, name, _ = current[-1]
+        minutes = int((localize(event_end, local_tz) - now).total_seconds() / 60)
+        text = f"Now: {name} ending in {minutes_text(minutes)}"
+        tooltip = f"Now: {name} {localize(event_start, local_tz):%H:%M} - {localize(event_end, local_tz):%H:%M}"
+        if next_event is not None:
+            _, _, event_start, event_end, name, _ = next_event
+            tooltip += f"\nNext: {name} {localize(event_start, local_tz):%H:%M} - {localize(event_end, local_tz):%H:%M}"
+    elif next_event is not None:
+        _, _, event_start, event_end, name, _ = next_event
+        minutes = int((localize(event_start, local_tz) - now).total_seconds() / 60)
+        text = f"Next event: {name} starting in {minutes_text(minutes)}"
+        tooltip = f"Start: {localize(event_start, local_tz):%H:%M} \n End: {localize(event_end, local_tz):%H:%M}"
+    else:
+        return None
+
+    return {"text": text, "alt": "Alt-text", "tooltip": tooltip}
+
 
-        d = {
-            "text": f"Next event: {info['title']} starting in {upcoming}",
-            "alt": "Alt-text",
-            "tooltip": f"Start: {info['start']} \n End: {info['end']}",
-        }
+def write_line(d):
+    profiling.count("lines written")
+    sys.stdout.write(json.dumps(d))
+    sys.stdout.write("\n")
+    sys.stdout.flush()
+
+
+def follow(tz_name, interval=FOLLOW_INTERVAL):
+    """Keeps running and writes a line only when the widget output changes.
+    For use with waybar's continuous exec mode (no "interval" in the module config)"""
+    last = None
+    while True:
+        # waybar keeps showing the last line, so an empty text is needed to clear the widget
+        try:
+            with profiling.span("widget"):
+                d = widget(tz_name) or {"text": ""}
+        except Exception as e:
+            # Such as "database is locked" during a long sync. waybar doesn't restart the widget if it exits,
+            # so the last line stays up and the next check tries again
+            print(f"Couldn't check for events: {type(e).__name__}: {e}", file=sys.stderr)
+            d = last
+        if d != last:
+            write_line(d)
+            last = d
+
+        # Wake up just after the minute turns over so the countdown stays accurate
+        now = systime.time()
+        systime.sleep(min(interval, 60 - now % 60 + 0.5))
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    imported = systime.perf_counter()
+
+    tz_name = "Australia/Melbourne"
+
+    # argparse costs more to import than the rest of the widget, so only pay for it when there are options
+    if argv:
+        import argparse
+
+        parser = argparse.ArgumentParser(description="Print the next calendar event for waybar")
+        parser.add_argument(
+            "--follow", action="store_true", help="keep running and print a line whenever the text changes"
+        )
+        parser.add_argument(
+            "--interval", type=float, default=FOLLOW_INTERVAL, help="maximum seconds between checks in --follow mode"
+        )
+        parser.add_argument("--profile", action="store_true", help="write timings to stderr on exit")
+        parser.add_argument(
+            "--profile-format", choices=profiling.MODES, default="summary", help="how --profile writes timings"
+        )
+        args = parser.parse_args(argv)
+
+        if args.profile:
+            profiling.enable(args.profile_format)
+        profiling.record("imports", profiling.STARTED, imported)
+
+        if args.follow:
+            try:
+                follow(tz_name, args.interval)
+            except (KeyboardInterrupt, BrokenPipeError):
+                # waybar closes the pipe when it reloads
+                pass
+            return
+    else:
+        profiling.record("imports", profiling.STARTED, imported)
 
-        sys.stdout.write(json.dumps(d))
-        sys.stdout.write("\n")
-        sys.stdout.flush()
+    with profiling.span("widget"):
+        d = widget(tz_name)
+    if d is not None:
+        with profiling.span("write"):
+            write_line(d)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,62 @@
+"""Owns opening cal.db. The database runs in WAL mode so the widget, the GTK app and a sync can all use it at once,
+and connections are kept open and reused within each thread. Only uses the standard library so the widget can
+import it cheaply"""
+import os, sqlite3, threading
+
+import profiling
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+# WAYBAR_CALENDAR_DB points everything at another database, such as one generated by the benchmarks
+DB_PATH = os.environ.get("WAYBAR_CALENDAR_DB") or f"{dir_path}/cal.db"
+
+# Applied to every connection. journal_mode is stored in the database file so it is only set by writers
+PRAGMAS = (
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA mmap_size = 67108864",
+    "PRAGMA cache_size = -8000",
+    "PRAGMA temp_store = MEMORY",
+    # Wait for a writer instead of failing with "database is locked"
+    "PRAGMA busy_timeout = 5000",
+)
+
+_local = threading.local()
+
+
+def _open(path, readonly):
+    if readonly:
+        con = sqlite3.connect(f"file:{path}?mode=ro", uri=True, detect_types=sqlite3.PARSE_COLNAMES)
+    else:
+        con = sqlite3.connect(path, detect_types=sqlite3.PARSE_COLNAMES)
+        con.execute("PRAGMA journal_mode = WAL")
+
+    for pragma in PRAGMAS:
+        con.execute(pragma)
+
+    return con
+
+
+def connect(readonly: bool = False):
+    """Returns this thread's connection to DB_PATH, opening it on first use.
+    Read-only connections never take the write lock. Set row_factory on cursors, not on the shared connection"""
+    # A reader can't create the database, so the first use of a new database opens it writable
+    if readonly and not os.path.exists(DB_PATH):
+        readonly = False
+
+    connections = getattr(_local, "connections", None)
+    if connections is None:
+        connections = _local.connections = {}
+
+    key = (DB_PATH, readonly)
+    con = connections.get(key)
+    if con is None:
+        with profiling.span("connect"):
+            con = connections[key] = _open(DB_PATH, readonly)
+
+    return con
+
+
+def close():
+    """Closes this thread's connections"""
+    for con in getattr(_local, "connections", {}).values():
+        con.close()
+    _local.connections = {}
@@ -0,0 +1,279 @@
+"""A compact, read-only store of events kept as columns. Start and end epochs sit in contiguous arrays sorted by
+start, and calendar ids and names are interned, so a large local cache costs a few dozen bytes per event instead of
+a NamedTuple of datetimes and strings, and slicing by time is a bisect. Event objects are only built when an item is
+accessed"""
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime, date, timedelta, timezone
+from typing import Iterable, Iterator, Optional, Union
+
+from cal import Event, chunks, connect, to_epoch
+from intervals import IntervalIndex, in_progress
+from timezones import DAY, EPOCH_ORDINAL, get_localizer
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def from_epoch(seconds: int, all_day: bool) -> Union[datetime, date]:
+    if all_day:
+        return date.fromordinal(seconds // DAY + EPOCH_ORDINAL)
+    return EPOCH + timedelta(seconds=seconds)
+
+
+class EventStore:
+    """Events in columns, ordered by start then id. Indexing by position returns an Event, slicing returns an
+    EventStore sharing the interned tables, and get() looks events up by id"""
+
+    __slots__ = (
+        "starts",
+        "ends",
+        "all_day",
+        "calendars",
+        "names",
+        "ids",
+        "descriptions",
+        "_calendar_ids",
+        "_names",
+        "_positions",
+        "_indexes",
+    )
+
+    def __init__(self, calendar_ids: Optional[list[str]] = None, names: Optional[list[str]] = None):
+        self.starts = array("q")
+        self.ends = array("q")
+        self.all_day = array("b")
+        # Indexes into _calendar_ids and _names
+        self.calendars = array("l")
+        self.names = array("l")
+        self.ids = []
+        # Most events have no description, so only those that do are kept, by position
+        self.descriptions = {}
+
+        self._calendar_ids = calendar_ids if calendar_ids is not None else []
+        self._names = names if names is not None else []
+        self._positions = None
+        self._indexes = {}
+
+    @classmethod
+    def from_events(cls, events: Iterable[Event]) -> "EventStore":
+        store = cls()
+        rows = [
+            (to_epoch(event.start), event.id, to_epoch(event.end), type(event.start) is not datetime, event)
+            for event in events
+        ]
+        rows.sort(key=lambda row: row[:2])
+        store._extend(
+            (start, end, all_day, event.id, event.calendar_id, event.name, event.description)
+            for start, _, end, all_day, event in rows
+        )
+        return store
+
+    @classmethod
+    def read(
+        cls,
+        start: datetime,
+        end: datetime,
+        calendars: Optional[list[str]] = None,
+        limit: int = 0,
+        overlapping: bool = False,
+    ) -> "EventStore":
+        """Reads the events starting between start and end straight into columns, without building datetimes, at most
+        limit of them if given. With overlapping, every event that started before start and is still going at start
+        is read too, see intervals.in_progress. Events of active calendars are read unless calendars gives the
+        calendar ids"""
+        from recurrence import ensure_expanded
+
+        start_utc, end_utc = to_epoch(start), to_epoch(end)
+        # Recurring instances still going at start began at most a day or so earlier
+        ensure_expanded(start_utc - DAY if overlapping else start_utc, end_utc)
+
+        if calendars is None:
+            join = "INNER JOIN calendars ON events.calendar_id = calendars.id"
+            where = "active = 1"
+            params = {}
+        else:
+            join = ""
+            where = f"calendar_id IN ({', '.join(f':calendar{i}' for i in range(len(calendars)))})"
+            params = {f"calendar{i}": id for i, id in enumerate(calendars)}
+
+        select = f"""SELECT start_utc, end_utc, all_day, events.id, calendar_id, events.name, events.description
+        FROM events
+        {join}
+        """
+
+        con = connect(readonly=True)
+        queries = [("start_utc BETWEEN :start AND :end", {"start": start_utc, "end": end_utc, "limit": limit or -1})]
+        if overlapping:
+            # Everything in progress started before anything in the window. Long all day events can be in progress
+            # in any number, so they don't count towards the limit
+            queries.insert(0, (in_progress(con), {"at": start_utc, "limit": -1}))
+
+        store = cls()
+        for condition, values in queries:
+            query = f"{select} WHERE {condition} AND {where} ORDER BY start_utc, events.id LIMIT :limit"
+            store._extend(con.execute(query, {**values, **params}))
+
+        return store
+
+    @classmethod
+    def read_ids(cls, ids: Iterable[str]) -> "EventStore":
+        """Reads the events with ids, such as those in a change_log.Changes, leaving out any that have been deleted or
+        belong to inactive calendars"""
+        con = connect(readonly=True)
+        rows = []
+        for chunk in chunks(list(ids)):
+            rows += con.execute(
+                f"""SELECT start_utc, end_utc, all_day, events.id, calendar_id, events.name, events.description
+                FROM events
+                INNER JOIN calendars ON events.calendar_id = calendars.id
+                WHERE events.id IN ({', '.join('?' * len(chunk))}) AND active = 1
+                """,
+                chunk,
+            ).fetchall()
+
+        rows.sort(key=lambda row: (row[0], row[3]))
+        store = cls()
+        store._extend(rows)
+        return store
+
+    def _extend(self, rows: Iterable[tuple]):
+        """Appends (start_utc, end_utc, all_day, id, calendar_id, name, description) rows, which must already be
+        in order"""
+        calendar_index = {id: i for i, id in enumerate(self._calendar_ids)}
+        name_index = {name: i for i, name in enumerate(self._names)}
+
+        for start, end, all_day, id, calendar_id, name, description in rows:
+            i = calendar_index.get(calendar_id)
+            if i is None:
+                i = calendar_index[calendar_id] = len(self._calendar_ids)
+                self._calendar_ids.append(calendar_id)
+            j = name_index.get(name)
+            if j is None:
+                j = name_index[name] = len(self._names)
+                self._names.append(name)
+
+            if description is not None:
+                self.descriptions[len(self.ids)] = description
+            self.starts.append(start)
+            self.ends.append(end)
+            self.all_day.append(bool(all_day))
+            self.calendars.append(i)
+            self.names.append(j)
+            self.ids.append(id)
+
+        self._positions = None
+        self._indexes = {}
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __iter__(self) -> Iterator[Event]:
+        return (self.event(i) for i in range(len(self.ids)))
+
+    def __getitem__(self, key: Union[int, slice]) -> Union[Event, "EventStore"]:
+        if isinstance(key, slice):
+            return self.take(range(len(self.ids))[key])
+        if key < 0:
+            key += len(self.ids)
+        return self.event(key)
+
+    def __repr__(self):
+        return f"EventStore({len(self)} events)"
+
+    def event(self, i: int) -> Event:
+        all_day = self.all_day[i]
+        return Event(
+            id=self.ids[i],
+            calendar_id=self._calendar_ids[self.calendars[i]],
+            start=from_epoch(self.starts[i], all_day),
+            end=from_epoch(self.ends[i], all_day),
+            name=self._names[self.names[i]],
+            description=self.descriptions.get(i),
+        )
+
+    def get(self, id: str) -> Optional[Event]:
+        if self._positions is None:
+            self._positions = {id: i for i, id in enumerate(self.ids)}
+        i = self._positions.get(id)
+        return None if i is None else self.event(i)
+
+    def take(self, positions: Iterable[int]) -> "EventStore":
+        """A new store of the events at positions, which must be increasing"""
+        store = EventStore(self._calendar_ids, self._names)
+        if isinstance(positions, range) and positions.step == 1:
+            i, j = positions.start, positions.stop
+            store.starts = self.starts[i:j]
+            store.ends = self.ends[i:j]
+            store.all_day = self.all_day[i:j]
+            store.calendars = self.calendars[i:j]
+            store.names = self.names[i:j]
+            store.ids = self.ids[i:j]
+        else:
+            positions = list(positions)
+            store.starts = array("q", [self.starts[i] for i in positions])
+            store.ends = array("q", [self.ends[i] for i in positions])
+            store.all_day = array("b", [self.all_day[i] for i in positions])
+            store.calendars = array("l", [self.calendars[i] for i in positions])
+            store.names = array("l", [self.names[i] for i in positions])
+            store.ids = [self.ids[i] for i in positions]
+
+        descriptions = self.descriptions
+        store.descriptions = {k: descriptions[i] for k, i in enumerate(positions) if i in descriptions}
+        return store
+
+    def between(self, start: datetime, end: datetime) -> "EventStore":
+        """The events starting between start and end, found by bisecting the start column"""
+        i = bisect_left(self.starts, to_epoch(start))
+        j = bisect_right(self.starts, to_epoch(end))
+        return self[i:j]
+
+    def group(self, tz_name: str, interval: str = "day") -> dict[date, "EventStore"]:
+        """Like timezones.Localizer.group, but working on the epoch columns directly"""
+        localizer = get_localizer(tz_name)
+        if self.starts:
+            localizer.cover(self.starts[0], self.starts[-1])
+
+        buckets = {}
+        for i, (start, all_day) in enumerate(zip(self.starts, self.all_day)):
+            day = start // DAY if all_day else (start + localizer.offset(start)) // DAY
+            buckets.setdefault(day, []).append(i)
+
+        split = {}
+        for day in sorted(buckets):
+            key = date.fromordinal(day + EPOCH_ORDINAL)
+            if interval == "week":
+                key -= timedelta(key.weekday())
+            elif interval == "month":
+                key = key.replace(day=1)
+            split.setdefault(key, []).extend(buckets[day])
+
+        return {key: self.take(sorted(positions)) for key, positions in split.items()}
+
+    def index(self, tz_name: str) -> IntervalIndex:
+        """An IntervalIndex over the events, built once per zone. All day events run from local midnight to local
+        midnight in tz_name"""
+        index = self._indexes.get(tz_name)
+        if index is None:
+            localizer = get_localizer(tz_name)
+            intervals = []
+            for start, end, all_day in zip(self.starts, self.ends, self.all_day):
+                if all_day:
+                    start -= localizer.offset(start - localizer.offset(start))
+                    end -= localizer.offset(end - localizer.offset(end))
+                intervals.append((start, end))
+            index = self._indexes[tz_name] = IntervalIndex(intervals)
+
+        return index
+
+    def active_at(self, t: datetime, tz_name: str = "UTC") -> "EventStore":
+        """The events happening at t"""
+        return self.take(sorted(self.index(tz_name).active_at(to_epoch(t))))
+
+    def overlapping(self, start: datetime, end: datetime, tz_name: str = "UTC") -> "EventStore":
+        """The events sharing any time with [start, end)"""
+        return self.take(sorted(self.index(tz_name).overlapping(to_epoch(start), to_epoch(end))))
+
+    def next_after(self, t: datetime, tz_name: str = "UTC") -> Optional[Event]:
+        """The first event starting after t"""
+        i = self.index(tz_name).next_after(to_epoch(t))
+        return None if i is None else self.event(i)
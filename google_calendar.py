@@ -1,13 +1,36 @@
-import os
-from datetime import datetime, timezone
+import os, json, threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Iterable, NamedTuple, Optional
 
 from google.auth import credentials
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib import flow
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from googleapiclient.errors import HttpError
 
-from cal import Calendar, Calendars, Event, Events
+from cal import Calendar, Calendars, Event, Events, Recurrence, read_sync_tokens, write_sync_tokens
+import profiling, recurrence
+
+# Calendars fetched at once by sync_events
+FETCH_WORKERS = 8
+
+# Largest pages the API allows
+EVENT_PAGE_SIZE = 2500
+CALENDAR_PAGE_SIZE = 250
+
+# Only the parts of each resource that are stored in cal.Calendar and cal.Event
+EVENT_FIELDS = (
+    "items(id,status,summary,description,start(date,dateTime,timeZone),end(date,dateTime,timeZone),"
+    "recurrence,recurringEventId,originalStartTime(date,dateTime))"
+)
+CALENDAR_FIELDS = "items(id,summary,summaryOverride,description,timeZone,selected)"
+
+# Set to a timedelta to only sync events that far ahead, instead of incrementally syncing whole calendars
+SYNC_HORIZON = None
 
 
 def authorize(cred_path, launch_browser=True):
@@ -41,70 +64,235 @@ def authorize(cred_path, launch_browser=True):
     return creds
 
 
-def getCalendarList(service):
-    calendar_list = None
+class SyncCancelled(Exception):
+    """Raised when a sync is cancelled. Nothing has been written by then"""
+
+
+class SyncFailed(Exception):
+    """Raised by sync_events when some calendars couldn't be fetched, once the rest have been written"""
+
+    def __init__(self, errors: dict[str, Exception], changes: dict[str, int]):
+        super().__init__(
+            f"{len(errors)} calendars couldn't be synced: "
+            + "; ".join(f"{id}: {error}" for id, error in errors.items())
+        )
+        # The error of each calendar that failed, and what sync_events would have returned for the rest
+        self.errors = errors
+        self.changes = changes
+
+
+def check_cancelled(cancel: Optional[threading.Event]):
+    if cancel is not None and cancel.is_set():
+        raise SyncCancelled()
+
+
+def iterPages(list_method, cancel: Optional[threading.Event] = None, **kwargs):
+    """Yields every page of a list request, following nextPageToken until the last page.
+    Raises SyncCancelled before the next request once cancel is set"""
     page_token = None
     while True:
-        calendar_list = service.calendarList().list(pageToken=page_token).execute()
-
-        page_token = calendar_list.get("nextPageToken")
+        check_cancelled(cancel)
+        with profiling.span("http"):
+            page = list_method(pageToken=page_token, **kwargs).execute()
+        profiling.count("api calls")
+        if profiling.ENABLED:
+            profiling.count("api bytes", len(json.dumps(page)))
+        yield page
+
+        page_token = page.get("nextPageToken")
         if not page_token:
             break
 
-    return calendar_list
 
+class Session:
+    """Authorizes once and keeps the credentials and built service objects for repeated syncs in one process.
+    A service object can only be used by one thread at a time, so they are handed out by service() and returned
+    to a pool afterwards"""
 
-def getEvent(service, calendar_id):
-    page_token = None
-    now = datetime.now(timezone.utc).isoformat()
+    def __init__(self, cred_path="secrets.json", launch_browser=True):
+        self.cred_path = cred_path
+        self.launch_browser = launch_browser
+        self._creds = None
+        self._services = []
+        self._lock = threading.Lock()
 
-    found_events = 0
+    @property
+    def credentials(self):
+        """Authorizes on first use, after that only refreshes the token once it has expired"""
+        with self._lock, profiling.span("auth"):
+            if self._creds is None:
+                self._creds = authorize(self.cred_path, self.launch_browser)
+            elif self._creds.expired and self._creds.refresh_token:
+                self._creds.refresh(Request())
+                with open("token.json", "w") as token:
+                    token.write(self._creds.to_json())
 
-    events_collected = {}
+            return self._creds
 
-    while True:
-        events = (
-            service.events()
-            .list(
-                calendarId=calendar_id,
-                timeMin=now,
-                maxResults=10,
-                singleEvents=True,
-                orderBy="startTime",
-                pageToken=page_token,
-            )
-            .execute()
-        )
-        found_events += len(events)
-        event_tuples = {}
-        for event in events["items"]:
-            if "dateTime" in event["start"]:
-                start = datetime.fromisoformat(event["start"]["dateTime"]).astimezone(timezone.utc)
-                end = datetime.fromisoformat(event["end"]["dateTime"]).astimezone(timezone.utc)
-            else:
-                start = datetime.fromisoformat(event["start"]["date"]).date()
-                end = datetime.fromisoformat(event["end"]["date"]).date()
-            if "description" in event:
-                description = event["description"]
-            else:
-                description = None
-            event_tuples[event["id"]] = Event(
-                id=event["id"],
-                calendar_id=calendar_id,
-                start=start,
-                end=end,
-                name=event["summary"],
-                description=description,
-            )
-            print(f"---- Event: {event['summary']} at {event['start']} ending {event['end']}")
+    @contextmanager
+    def service(self):
+        """Lends out a service object, building one from the bundled discovery document if none are free"""
+        credentials = self.credentials
+        with self._lock:
+            service = self._services.pop() if self._services else None
+        if service is None:
+            with profiling.span("build service"):
+                service = build_from_document(discoveryDocument(), credentials=credentials)
 
-        events_collected.update(event_tuples)
+        try:
+            yield service
+        finally:
+            with self._lock:
+                self._services.append(service)
 
-        page_token = events.get("nextPageToken")
-        if not page_token or found_events > 5:
-            break
 
-    return events_collected
+_discovery_document = None
+_session = None
+
+
+def discoveryDocument():
+    """The Calendar API discovery document bundled with googleapiclient, parsed once per process"""
+    global _discovery_document
+    if _discovery_document is None:
+        _discovery_document = json.loads(get_static_doc("calendar", "v3"))
+
+    return _discovery_document
+
+
+def getSession():
+    """The process wide Session used when a sync function isn't given one"""
+    global _session
+    if _session is None:
+        _session = Session()
+
+    return _session
+
+
+def getCalendarList(service):
+    """Returns every calendar list entry, in the same shape as a single page of the response"""
+    items = []
+    for page in iterPages(
+        service.calendarList().list, maxResults=CALENDAR_PAGE_SIZE, fields=f"{CALENDAR_FIELDS},nextPageToken"
+    ):
+        items += page.get("items", [])
+
+    return {"items": items}
+
+
+def toTime(time):
+    """Converts an API start, end or originalStartTime into a UTC datetime, or a date for all day events"""
+    if "dateTime" in time:
+        return datetime.fromisoformat(time["dateTime"]).astimezone(timezone.utc)
+    else:
+        return datetime.fromisoformat(time["date"]).date()
+
+
+def toEvent(event, calendar_id):
+    """Converts an event resource from the API into a cal.Event"""
+    start = toTime(event["start"])
+    end = toTime(event["end"])
+    if "description" in event:
+        description = event["description"]
+    else:
+        description = None
+    return Event(
+        id=event["id"],
+        calendar_id=calendar_id,
+        start=start,
+        end=end,
+        name=event.get("summary", ""),
+        description=description,
+    )
+
+
+def toRecurrence(event, calendar_id):
+    """Converts the resource of a recurring event from the API into a cal.Recurrence"""
+    time_zone = event["start"].get("timeZone", "UTC")
+    start = toTime(event["start"])
+    end = toTime(event["end"])
+    if "dateTime" in event["start"]:
+        # Keep the local time of the first instance so the rules expand across daylight saving changes
+        start = start.astimezone(recurrence.get_zone(time_zone))
+        end = end.astimezone(recurrence.get_zone(time_zone))
+
+    return Recurrence(
+        id=event["id"],
+        calendar_id=calendar_id,
+        start=start,
+        end=end,
+        name=event.get("summary", ""),
+        description=event.get("description"),
+        time_zone=time_zone,
+        rules=tuple(event["recurrence"]),
+    )
+
+
+class CalendarChanges(NamedTuple):
+    """What a list of one calendar's events returned"""
+
+    events: dict[str, Event]
+    recurrences: dict[str, Recurrence]
+    # (recurrence id, original start) of instances that were moved or cancelled
+    exceptions: set[tuple]
+    cancelled: set[str]
+    sync_token: Optional[str]
+    full_sync: bool = False
+
+
+class SyncProgress(NamedTuple):
+    """Reported by sync_events each time a calendar has been fetched"""
+
+    calendars_done: int
+    calendars: int
+    events: int
+
+
+def getEvent(
+    service,
+    calendar_id,
+    sync_token=None,
+    horizon: Optional[timedelta] = None,
+    cancel: Optional[threading.Event] = None,
+) -> CalendarChanges:
+    """Lists the events of a calendar. With a sync_token only the changes since that token was issued are listed.
+    With a horizon only events between now and now + horizon are listed.
+    Recurring events are listed once with their rules, plus any instances that were changed or cancelled.
+    Raises HttpError 410 when Google has expired the token and a full sync is needed"""
+    kwargs = {}
+    if horizon is not None:
+        now = datetime.now(timezone.utc)
+        kwargs = {"timeMin": now.isoformat(), "timeMax": (now + horizon).isoformat()}
+    elif sync_token is not None:
+        kwargs = {"syncToken": sync_token}
+
+    changes = CalendarChanges(events={}, recurrences={}, exceptions=set(), cancelled=set(), sync_token=None)
+
+    for page in iterPages(
+        service.events().list,
+        cancel,
+        calendarId=calendar_id,
+        singleEvents=False,
+        maxResults=EVENT_PAGE_SIZE,
+        fields=f"{EVENT_FIELDS},nextPageToken,nextSyncToken",
+        **kwargs,
+    ):
+        for event in page.get("items", []):
+            id = event["id"]
+            if "recurringEventId" in event and "originalStartTime" in event:
+                changes.exceptions.add((event["recurringEventId"], toTime(event["originalStartTime"])))
+
+            if event.get("status") == "cancelled":
+                changes.cancelled.add(id)
+                changes.events.pop(id, None)
+                changes.recurrences.pop(id, None)
+            elif "recurrence" in event:
+                changes.recurrences[id] = toRecurrence(event, calendar_id)
+                changes.cancelled.discard(id)
+            else:
+                changes.events[id] = toEvent(event, calendar_id)
+                changes.cancelled.discard(id)
+
+    return changes._replace(sync_token=page.get("nextSyncToken"))
 
 
 def createCalendars(service):
@@ -136,45 +324,172 @@ def createCalendars(service):
     return calendars, calendar_list
 
 
-def sync_calendars():
-    creds = authorize("secrets.json")
-    service = build("calendar", "v3", credentials=creds)
+def sync_calendars(session: Optional[Session] = None, cancel: Optional[threading.Event] = None):
+    session = session or getSession()
 
-    calendars, calendar_list = createCalendars(service)
+    check_cancelled(cancel)
+    with session.service() as service:
+        calendars, calendar_list = createCalendars(service)
 
     calendars.write()
     return calendars
 
 
-def sync_events(calendars: Calendars):
-    creds = authorize("secrets.json")
-    service = build("calendar", "v3", credentials=creds)
+def syncCalendarEvents(
+    service,
+    calendar_id,
+    sync_token=None,
+    horizon: Optional[timedelta] = None,
+    cancel: Optional[threading.Event] = None,
+) -> CalendarChanges:
+    """Runs getEvent, falling back to a full sync if Google has expired the sync token.
+    full_sync is set on the result whenever it lists every event, rather than changes"""
+    if horizon is not None:
+        # Changes outside the window would be missed, so a bounded list never leaves a token behind
+        changes = getEvent(service, calendar_id, horizon=horizon, cancel=cancel)
+        return changes._replace(sync_token=None, full_sync=True)
+
+    try:
+        changes = getEvent(service, calendar_id, sync_token, cancel=cancel)
+    except HttpError as e:
+        if e.resp.status != 410 or sync_token is None:
+            raise
+        # The sync token has expired, start again from scratch
+        print(f"---- Sync token expired for {calendar_id}, running a full sync")
+        sync_token = None
+        changes = getEvent(service, calendar_id, cancel=cancel)
+
+    return changes._replace(full_sync=sync_token is None)
+
+
+def fetchEvents(
+    session: Session,
+    sync_tokens: dict[str, Optional[str]],
+    horizon: Optional[timedelta] = None,
+    max_workers: int = FETCH_WORKERS,
+    progress: Optional[Callable[[SyncProgress], None]] = None,
+    cancel: Optional[threading.Event] = None,
+):
+    """Runs syncCalendarEvents for every calendar id in sync_tokens concurrently on a bounded thread pool.
+    Service objects share an httplib2 connection that isn't thread safe, so each request borrows its own.
+    progress is called from the pool's threads as each calendar finishes. Raises SyncCancelled once cancel is set.
+    A calendar that fails doesn't stop the others. Returns dicts of the results and of the errors by calendar id"""
+    lock = threading.Lock()
+    done = SyncProgress(calendars_done=0, calendars=len(sync_tokens), events=0)
+
+    def fetch(calendar_id):
+        nonlocal done
+        check_cancelled(cancel)
+        with session.service() as service:
+            result = syncCalendarEvents(service, calendar_id, sync_tokens[calendar_id], horizon, cancel)
+
+        if progress is not None:
+            fetched = len(result.events) + len(result.recurrences) + len(result.cancelled)
+            with lock:
+                done = done._replace(calendars_done=done.calendars_done + 1, events=done.events + fetched)
+                progress(done)
+        return result
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {calendar_id: pool.submit(fetch, calendar_id) for calendar_id in sync_tokens}
+
+    results = {}
+    errors = {}
+    for calendar_id, future in futures.items():
+        try:
+            results[calendar_id] = future.result()
+        except Exception as e:
+            errors[calendar_id] = e
+    check_cancelled(cancel)
+
+    return results, errors
+
+
+def sync_events(
+    calendars: Calendars,
+    horizon: Optional[timedelta] = SYNC_HORIZON,
+    session: Optional[Session] = None,
+    calendar_ids: Optional[Iterable[str]] = None,
+    progress: Optional[Callable[[SyncProgress], None]] = None,
+    cancel: Optional[threading.Event] = None,
+):
+    """Syncs the events of the active calendars, or only the active calendars in calendar_ids.
+    Without a horizon this is an incremental sync using the stored sync tokens. With a horizon only events between
+    now and now + horizon are downloaded, every time.
+    progress is called with a SyncProgress from the fetching threads as each calendar is fetched. Setting cancel
+    stops the sync with SyncCancelled, which is checked before every request and before anything is written.
+    Returns the number of events changed or removed in each calendar. If any calendar fails, the others are still
+    written and SyncFailed is raised afterwards"""
+    session = session or getSession()
+
+    sync_tokens = read_sync_tokens()
+    active = calendars.active()
+    if calendar_ids is not None:
+        active = {id: active[id] for id in calendar_ids if id in active}
+
+    window = None
+    if horizon is not None:
+        now = datetime.now(timezone.utc)
+        window = (now, now + horizon)
+
+    with profiling.span("fetch"):
+        results, errors = fetchEvents(
+            session, {id: sync_tokens.get(id) for id in active}, horizon, progress=progress, cancel=cancel
+        )
+    check_cancelled(cancel)
 
     events_list = {}
-    for id, calendar in calendars.active().items():
-        print(f"Calendar: {calendar}")
-        events_list.update(getEvent(service, id))
-
-    events = Events(events_list)
-    events.write()
-
+    recurrences = {}
+    exceptions = set()
+    deleted = set()
+    full_syncs = []
+    new_tokens = {}
+    changes = {}
+    for id, result in results.items():
+        print(
+            f"Calendar: {active[id].name}: {len(result.events)} events and {len(result.recurrences)} recurring events "
+            f"changed, {len(result.cancelled)} cancelled"
+        )
+        changes[id] = len(result.events) + len(result.recurrences) + len(result.cancelled)
+        new_tokens[id] = result.sync_token
 
-if __name__ == "__main__":
-    creds = authorize("secrets.json")
-    service = build("calendar", "v3", credentials=creds)
+        # A full sync lists every event, so anything else stored for the calendar (in the window) is gone
+        if result.full_sync:
+            full_syncs.append(id)
 
-    calendars, calendar_list = createCalendars(service)
+        events_list.update(result.events)
+        recurrences.update(result.recurrences)
+        exceptions |= result.exceptions
+        deleted |= result.cancelled
 
-    events_list = []
+    # Everything is written in one transaction per table once all calendars are fetched. An event that became
+    # recurring, or stopped recurring, is removed from the table it was in before
+    events = Events(events_list)
+    result = events.write(deleted | recurrences.keys(), replace_calendars=full_syncs, window=window)
+    print(
+        f"Wrote {result.inserted} new, {result.updated} updated and {result.deleted} deleted events, "
+        f"{result.unchanged} unchanged"
+    )
+    # A bounded list only includes the recurring events with instances in the window, so they aren't replaced
+    with profiling.span("recurrence.write"):
+        result = recurrence.write(
+            recurrences,
+            exceptions,
+            deleted | events_list.keys(),
+            replace_calendars=full_syncs if window is None else (),
+        )
+    print(
+        f"Wrote {result.inserted} new, {result.updated} updated and {result.deleted} deleted recurring events, "
+        f"{result.unchanged} unchanged"
+    )
 
-    for calendar in calendars.active():
-        print(f"Calendar: {calendar}")
-        events_list += getEvent(calendar)
+    # Only store the tokens once the changes they cover are written
+    write_sync_tokens(new_tokens)
 
-    for calendar_list_entry in calendar_list["items"]:
-        print(f"Calendar: {calendar_list_entry['summary']}")
+    if errors:
+        raise SyncFailed(errors, changes)
+    return changes
 
-        events_list += getEvent(calendar_list_entry["id"])
 
-    events = Events(events_list)
-    events.write()
+if __name__ == "__main__":
+    sync_events(sync_calendars())
@@ -0,0 +1,246 @@
+"""Imports .ics exports into cal.db. Files are read one VEVENT at a time, so memory stays bounded however large
+the export is, and events are written in batches"""
+import os, re
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, date, timedelta, timezone
+from multiprocessing import get_context
+from typing import Iterator, Optional, Union
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from icalendar import Event as IcsEvent
+from icalendar.prop import vDuration
+
+import db, recurrence
+from cal import Calendar, Calendars, Event, Events, Recurrence, WriteResult
+
+# Events written per transaction
+IMPORT_BATCH = 2000
+
+UNFOLD = re.compile(r"\r?\n[ \t]")
+# NAME;PARAM=value;PARAM="quoted:value":VALUE
+CONTENT_LINE = re.compile(r'([^;:]+)((?:;[^;:="]+=(?:"[^"]*"|[^;:"]*))*):(.*)')
+PARAM = re.compile(r';([^;:="]+)=("[^"]*"|[^;:"]*)')
+TEXT_ESCAPE = re.compile(r"\\(.)")
+TEXT_ESCAPES = {"n": "\n", "N": "\n"}
+# Properties that make up the rules of a recurring event, each of which may appear more than once
+RULE_PROPERTIES = ("RRULE", "RDATE", "EXRULE", "EXDATE")
+
+
+def calendar_id(path) -> str:
+    return f"ics:{os.path.basename(path)}"
+
+
+def iter_components(path, name: str = "VEVENT") -> Iterator[str]:
+    """Yields the text of each top level component called name, reading the file line by line.
+    Continuation lines are kept as they are and unfolded when the component is parsed"""
+    begin = f"BEGIN:{name}"
+    end = f"END:{name}"
+    lines = None
+
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        for line in f:
+            if lines is None:
+                if line.rstrip("\r\n").upper() == begin:
+                    lines = [line]
+                continue
+
+            lines.append(line)
+            if line.rstrip("\r\n").upper() == end:
+                yield "".join(lines)
+                lines = None
+
+
+def iter_lines(text: str) -> Iterator[str]:
+    """Yields the unfolded content lines of a component, skipping any nested components such as VALARM"""
+    depth = 0
+    for line in UNFOLD.sub("", text).splitlines()[1:-1]:
+        upper = line.upper()
+        if upper.startswith("BEGIN:"):
+            depth += 1
+            continue
+        if upper.startswith("END:"):
+            depth -= 1
+            continue
+        if depth or not line:
+            continue
+
+        yield line
+
+
+def parse_properties(text: str) -> dict[str, tuple[dict[str, str], str]]:
+    """Splits a component into {NAME: (parameters, raw value)}. Only the first occurrence of a property is kept"""
+    properties = {}
+    for line in iter_lines(text):
+        match = CONTENT_LINE.match(line)
+        if match is None:
+            continue
+        name, params, value = match.groups()
+        name = name.upper()
+        if name in properties:
+            continue
+
+        parameters = {}
+        if params:
+            for param in PARAM.finditer(params):
+                parameters[param.group(1).upper()] = param.group(2).strip('"')
+        properties[name] = (parameters, value)
+
+    return properties
+
+
+def parse_datetime(parameters: dict[str, str], value: str):
+    """Parses a DATE or DATE-TIME value, raising KeyError or ValueError for anything unusual"""
+    if len(value) == 8:
+        return date(int(value[:4]), int(value[4:6]), int(value[6:8]))
+
+    obj = datetime.strptime(value[:15], "%Y%m%dT%H%M%S")
+    if value.endswith("Z"):
+        return obj.replace(tzinfo=timezone.utc)
+    if "TZID" in parameters:
+        return obj.replace(tzinfo=ZoneInfo(parameters["TZID"]))
+    return obj
+
+
+def unescape(value: str) -> str:
+    return TEXT_ESCAPE.sub(lambda match: TEXT_ESCAPES.get(match.group(1), match.group(1)), value)
+
+
+def to_utc(obj):
+    """Aware datetimes are converted to UTC, floating times are taken as UTC and dates are left as dates"""
+    if type(obj) is datetime:
+        if obj.tzinfo is None:
+            return obj.replace(tzinfo=timezone.utc)
+        return obj.astimezone(timezone.utc)
+    return obj
+
+
+def rule_lines(text: str) -> tuple[str, ...]:
+    """The RRULE, RDATE, EXRULE and EXDATE lines of a component, as dateutil's rrulestr takes them"""
+    return tuple(
+        line for line in iter_lines(text) if line.split(":", 1)[0].split(";", 1)[0].upper() in RULE_PROPERTIES
+    )
+
+
+def time_zone_name(obj) -> str:
+    """The IANA name of an aware datetime's zone, or UTC for anything else"""
+    tzinfo = getattr(obj, "tzinfo", None)
+    # zoneinfo calls it key, pytz (used by older icalendar) zone
+    return getattr(tzinfo, "key", None) or getattr(tzinfo, "zone", None) or "UTC"
+
+
+def to_event(text: str, cal_id: str) -> Optional[tuple[Union[Event, Recurrence], Optional[tuple[str, datetime]]]]:
+    """Maps the text of a VEVENT to a cal.Event, or a cal.Recurrence for recurring events. Changed instances of a
+    recurring event also return the (recurrence id, original start) exception. Returns None for events without a
+    start or uid. Values are parsed directly, only falling back to icalendar for time zones or formats that aren't
+    handled here"""
+    properties = parse_properties(text)
+    if "DTSTART" not in properties or "UID" not in properties:
+        return None
+
+    try:
+        start = parse_datetime(*properties["DTSTART"])
+        end = parse_datetime(*properties["DTEND"]) if "DTEND" in properties else None
+        recurrence_id = parse_datetime(*properties["RECURRENCE-ID"]) if "RECURRENCE-ID" in properties else None
+    except (KeyError, ValueError, ZoneInfoNotFoundError):
+        # Windows time zone names, custom VTIMEZONEs and other oddities
+        component = IcsEvent.from_ical(text)
+        start = component["dtstart"].dt
+        end = component["dtend"].dt if "dtend" in component else None
+        recurrence_id = component["recurrence-id"].dt if "recurrence-id" in component else None
+
+    if end is None:
+        if "DURATION" in properties:
+            end = start + vDuration.from_ical(properties["DURATION"][1])
+        elif type(start) is date:
+            end = start + timedelta(1)
+        else:
+            end = start
+
+    id = properties["UID"][1]
+    name = unescape(properties["SUMMARY"][1]) if "SUMMARY" in properties else ""
+    description = unescape(properties["DESCRIPTION"][1]) if "DESCRIPTION" in properties else None
+
+    if recurrence_id is None and ("RRULE" in properties or "RDATE" in properties):
+        # Kept in its own time zone, floating times are taken as UTC
+        if type(start) is datetime and start.tzinfo is None:
+            start, end = to_utc(start), to_utc(end)
+        return (
+            Recurrence(
+                id=id,
+                calendar_id=cal_id,
+                start=start,
+                end=end,
+                name=name,
+                description=description,
+                time_zone=time_zone_name(start),
+                rules=rule_lines(text),
+            ),
+            None,
+        )
+
+    exception = None
+    # Changed instances of a recurring event share its UID
+    if recurrence_id is not None:
+        recurrence_id = to_utc(recurrence_id)
+        exception = (id, recurrence_id)
+        id = recurrence.instance_id(id, recurrence_id)
+
+    event = Event(id=id, calendar_id=cal_id, start=to_utc(start), end=to_utc(end), name=name, description=description)
+    return event, exception
+
+
+def import_file(path, batch: int = IMPORT_BATCH) -> WriteResult:
+    """Parses and writes one file, batch events per transaction. Recurring events are counted with the events"""
+    cal_id = calendar_id(path)
+    totals = WriteResult()
+    events = {}
+    recurrences = {}
+    exceptions = set()
+
+    def flush():
+        results = [Events(events).write(), recurrence.write(recurrences, exceptions)]
+        events.clear()
+        recurrences.clear()
+        exceptions.clear()
+        return WriteResult(*(sum(counts) for counts in zip(totals, *results)))
+
+    for text in iter_components(path):
+        parsed = to_event(text, cal_id)
+        if parsed is None:
+            continue
+
+        item, exception = parsed
+        if type(item) is Recurrence:
+            recurrences[item.id] = item
+        else:
+            events[item.id] = item
+        if exception is not None:
+            exceptions.add(exception)
+
+        if len(events) + len(recurrences) >= batch:
+            totals = flush()
+
+    if events or recurrences:
+        totals = flush()
+
+    return totals
+
+
+def import_files(paths: list[str], workers: Optional[int] = None) -> dict[str, WriteResult]:
+    """Imports each file into its own active calendar, parsing the files in parallel worker processes"""
+    existing = Calendars()
+    new = {
+        calendar_id(path): Calendar(id=calendar_id(path), name=os.path.basename(path), active=True)
+        for path in paths
+        if calendar_id(path) not in existing
+    }
+    if new:
+        Calendars(new).write()
+
+    if len(paths) == 1:
+        return {paths[0]: import_file(paths[0])}
+
+    # Connections must not be shared with child processes
+    db.close()
+    with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn")) as pool:
+        return dict(zip(paths, pool.map(import_file, paths)))
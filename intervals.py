@@ -0,0 +1,86 @@
+"""An index over (start, end) epoch intervals for finding what is happening at a time, what overlaps a window and
+what comes next. Intervals are sorted by start, and an implicit segment tree holds the latest end under each node, so
+queries are a bisect plus a walk down only the branches that contain a match. Only uses the standard library so the
+widget can import it cheaply"""
+from array import array
+from bisect import bisect_left, bisect_right
+from typing import Optional, Sequence
+
+# Without the events_rtree table, reads of a window only look this many seconds before it for events still in
+# progress, so longer events that started earlier are missed
+OVERLAP_LOOKBACK = 31 * 24 * 60 * 60
+
+_MIN = -(2**63)
+
+
+def in_progress(con) -> str:
+    """SQL condition on the events table for events that started before the named parameter :at and are still going
+    at :at. Finds them through events_rtree when the database has it, otherwise searches OVERLAP_LOOKBACK back"""
+    if con.execute("SELECT 1 FROM sqlite_master WHERE name = 'events_rtree'").fetchone() is not None:
+        # The R*Tree bounds are rounded outwards, so its matches are checked against the exact epochs. The unary
+        # plus keeps the planner from scanning the start_utc index instead
+        return (
+            "events.rowid IN (SELECT id FROM events_rtree WHERE start_utc < :at AND end_utc > :at) "
+            "AND +start_utc < :at AND end_utc > :at"
+        )
+    return f"start_utc >= :at - {OVERLAP_LOOKBACK} AND start_utc < :at AND end_utc > :at"
+
+
+class IntervalIndex:
+    """Built over a sequence of (start, end) pairs. Queries return the positions of matching pairs in that sequence,
+    in order of start. Intervals are half open: an interval contains its start but not its end"""
+
+    __slots__ = ("starts", "ends", "positions", "_tree", "_size")
+
+    def __init__(self, intervals: Sequence[tuple[int, int]]):
+        order = sorted(range(len(intervals)), key=lambda i: intervals[i][0])
+        self.positions = array("l", order)
+        self.starts = array("q", [intervals[i][0] for i in order])
+        self.ends = array("q", [intervals[i][1] for i in order])
+
+        # Leaves hold the ends in start order, every other node the latest end of its two children
+        size = 1
+        while size < len(order):
+            size *= 2
+        tree = array("q", [_MIN]) * (2 * size)
+        tree[size : size + len(order)] = self.ends
+        for node in range(size - 1, 0, -1):
+            tree[node] = max(tree[2 * node], tree[2 * node + 1])
+
+        self._tree = tree
+        self._size = size
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def _ending_after(self, count: int, t: int) -> list[int]:
+        """Positions of the intervals among the first count, in order of start, that end after t"""
+        tree, size, positions = self._tree, self._size, self.positions
+        found = []
+        stack = [(1, 0, size)]
+        while stack:
+            node, low, high = stack.pop()
+            if low >= count or tree[node] <= t:
+                continue
+            if node >= size:
+                found.append(positions[low])
+                continue
+
+            middle = (low + high) // 2
+            stack.append((2 * node + 1, middle, high))
+            stack.append((2 * node, low, middle))
+
+        return found
+
+    def active_at(self, t: int) -> list[int]:
+        """Intervals containing t"""
+        return self._ending_after(bisect_right(self.starts, t), t)
+
+    def overlapping(self, start: int, end: int) -> list[int]:
+        """Intervals sharing any time with [start, end)"""
+        return self._ending_after(bisect_left(self.starts, end), start)
+
+    def next_after(self, t: int) -> Optional[int]:
+        """The first interval starting after t, or None"""
+        i = bisect_right(self.starts, t)
+        return self.positions[i] if i < len(self.positions) else None
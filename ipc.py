@@ -0,0 +1,77 @@
+"""The protocol between server.py and its clients: JSON lines over a Unix socket. Each request is one line holding an
+object with a "method" and its parameters, and is answered by one line holding {"result": ...} or {"error": "..."}.
+A connection can carry any number of requests. Events are sent as [id, calendar_id, start, end, name, description]
+lists with ISO 8601 times, dates for all day events, the same as the snapshot. Only uses the standard library so the
+widget can import it cheaply"""
+import json, os, zlib
+from datetime import date
+
+import db
+
+# Seconds a client waits for the server before giving up on it
+TIMEOUT = 2.0
+
+
+def socket_path() -> str:
+    """WAYBAR_CALENDAR_SOCKET, or a socket in the runtime directory named after db.DB_PATH, so a server only ever
+    answers for the database its clients would read"""
+    path = os.environ.get("WAYBAR_CALENDAR_SOCKET")
+    if path:
+        return path
+    directory = os.environ.get("XDG_RUNTIME_DIR") or "/tmp"
+    return os.path.join(directory, f"waybar-calendar-{zlib.crc32(os.path.realpath(db.DB_PATH).encode()):08x}.sock")
+
+
+def event_row(event) -> list:
+    """An Event as a list for JSON"""
+    return [value.isoformat() if isinstance(value, date) else value for value in event]
+
+
+class ServerError(Exception):
+    """The server answered with an error"""
+
+
+class Client:
+    """A connection to server.py. Raises OSError if no server is listening"""
+
+    def __init__(self, path: str = None, timeout: float = TIMEOUT):
+        # socket takes longer to import than the rest of the widget, so it's only imported once there is a server
+        import socket
+
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.settimeout(timeout)
+        try:
+            self._socket.connect(path or socket_path())
+        except OSError:
+            self._socket.close()
+            raise
+        self._file = self._socket.makefile("rwb")
+
+    def request(self, method: str, **params):
+        """Sends one request and returns its result. Raises ServerError for an error response and OSError if the
+        connection fails"""
+        self._file.write(json.dumps({"method": method, **params}).encode())
+        self._file.write(b"\n")
+        self._file.flush()
+
+        line = self._file.readline()
+        if not line:
+            raise ConnectionError("server closed the connection")
+        response = json.loads(line)
+        if "error" in response:
+            raise ServerError(response["error"])
+        return response["result"]
+
+    def close(self):
+        try:
+            self._file.close()
+        except OSError:
+            # A request that couldn't be sent is dropped once the server has gone
+            pass
+        self._socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -1,68 +1,56 @@
-from icalendar import Calendar, Event
-from datetime import datetime, date, timedelta, time
-from typing import Union
-import pytz
-import sqlite3
+import argparse
 
+import profiling
 
-def read_sqlite_datetime(datetimebyte):
-    return datetime.fromisoformat(datetimebyte.decode())
 
+def import_ics(args):
+    # icalendar is only needed by this command
+    from ics_import import import_files
 
-sqlite3.register_converter("datetime", read_sqlite_datetime)
+    for path, result in import_files(args.files, args.workers).items():
+        print(f"{path}: {result.inserted} new, {result.updated} updated, {result.unchanged} unchanged events")
 
-con = sqlite3.connect("cal.db", detect_types=sqlite3.PARSE_COLNAMES)
 
-cur = con.cursor()
-cur.execute(
-    "CREATE TABLE IF NOT EXISTS events (uid TEXT PRIMARY KEY NOT NULL, start TEXT, end TEXT, title TEXT, description TEXT, type TEXT, UNIQUE(uid));"
-)
-con.commit()
+def search(args):
+    from datetime import datetime, timedelta, timezone
+    from cal import Events
 
-local_tz = pytz.timezone("Australia/Melbourne")
-now_local_start = local_tz.localize(datetime(2021, 7, 14))
-now_local_end = now_local_start + timedelta(1)
-now_start = now_local_start.astimezone(pytz.utc)
-now_end = now_local_end.astimezone(pytz.utc)
+    window = None
+    if args.days is not None:
+        now = datetime.now(timezone.utc)
+        window = (now - timedelta(args.days), now + timedelta(args.days))
 
+    for event in Events.search(" ".join(args.query), window, args.limit).values():
+        start = event.local_start(args.time_zone)
+        when = f"{start:%Y-%m-%d %H:%M}" if type(start) is datetime else f"{start:%Y-%m-%d}      "
+        print(f"{when}  {event.name}")
 
-def datetime_to_date(obj: Union[datetime, date], end=False) -> date:
-    if type(obj) is date:
-        if not end:
-            return pytz.utc.localize(datetime.combine(obj, datetime.min.time()))
-        else:
-            return pytz.utc.localize(datetime.combine(obj, datetime.min.time())) + timedelta(1)
-    return obj
 
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="waybar-calendar commands")
+    parser.add_argument("--profile", action="store_true", help="write timings to stderr on exit")
+    parser.add_argument(
+        "--profile-format", choices=profiling.MODES, default="summary", help="how --profile writes timings"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
 
-g = open("example.ics", "r")
-gcal = Calendar.from_ical(g.read())
-for cal in gcal.walk():
-    for event in cal.subcomponents:
-        if type(event) is not Event or "dtend" not in event:
-            continue
+    parser_import = subparsers.add_parser("import-ics", help="import events from .ics files")
+    parser_import.add_argument("files", nargs="+", help="each file is imported as its own calendar")
+    parser_import.add_argument("--workers", type=int, default=None, help="processes parsing files at once")
+    parser_import.set_defaults(func=import_ics)
 
-        if type(event["dtstart"].dt) is date:
-            event_type = "allday"
-        else:
-            event_type = "timed"
-        start = datetime_to_date(event["dtstart"].dt)
-        end = datetime_to_date(event["dtend"].dt, end=True)
+    parser_search = subparsers.add_parser("search", help="search event names and descriptions")
+    parser_search.add_argument("query", nargs="+", help="words the events contain, or the beginnings of them")
+    parser_search.add_argument("--days", type=int, default=None, help="only search this many days either side of now")
+    parser_search.add_argument("--limit", type=int, default=20)
+    parser_search.add_argument("--time-zone", default="Australia/Melbourne", help="time zone times are shown in")
+    parser_search.set_defaults(func=search)
 
-        vars = (str(event["uid"]), start, end, str(event["summary"]), str(event["description"]), event_type)
+    args = parser.parse_args(argv)
+    if args.profile:
+        profiling.enable(args.profile_format)
+    args.func(args)
 
-        cur.execute("INSERT OR REPLACE INTO events VALUES (?, ?, ?, ?, ?, ?)", vars)
-
-con.commit()
-
-results = cur.execute(
-    "SELECT start AS 'start [datetime]', end AS 'end [datetime]', title FROM events WHERE start BETWEEN ? AND ? AND type = 'timed'",
-    (now_start, now_end),
-)
-matches = list(results)
-print(matches)
-
-con.close()
 
 if __name__ == "__main__":
-    print("main")
+    main()
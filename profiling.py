@@ -0,0 +1,133 @@
+"""Opt-in timing of nested spans and counting of rows, bytes and API calls. Set WAYBAR_CALENDAR_PROFILE to summary,
+json or cprofile (or pass --profile, and --profile-format, to check_db.py or main.py) and a report is written to
+stderr when the process exits, leaving stdout to waybar. When it is off, span() returns a shared no-op context, so
+instrumented code costs next to nothing. Only uses the standard library so the widget can import it cheaply"""
+import atexit, functools, json, os, sys, threading, time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+MODES = ("summary", "json", "cprofile")
+
+# perf_counter when this module was imported, which is close to when the process started
+STARTED = time.perf_counter()
+
+ENABLED = False
+_mode = None
+_profile = None
+_spans = []
+_counters = defaultdict(int)
+_local = threading.local()
+_NULL = nullcontext()
+
+
+def enable(mode: str = "summary"):
+    """Starts recording and registers the report for exit. Calling it again does nothing"""
+    global ENABLED, _mode, _profile
+    if ENABLED:
+        return
+    if mode not in MODES:
+        mode = "summary"
+
+    ENABLED = True
+    _mode = mode
+    if mode == "cprofile":
+        import cProfile
+
+        _profile = cProfile.Profile()
+        _profile.enable()
+    atexit.register(report)
+
+
+@contextmanager
+def _span(name: str):
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+
+    stack.append(name)
+    path = "/".join(stack)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _spans.append((path, start - STARTED, time.perf_counter() - start, threading.current_thread().name))
+        stack.pop()
+
+
+def span(name: str):
+    """Context manager timing a block. Spans opened inside it are recorded under its name"""
+    if not ENABLED:
+        return _NULL
+    return _span(name)
+
+
+def timed(name: str):
+    """Decorator timing every call of a function as a span"""
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return function(*args, **kwargs)
+            with _span(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def record(name: str, start: float, end: float = None):
+    """Records a span from perf_counter start to end, or now, for time measured before profiling could wrap it,
+    such as imports"""
+    if ENABLED:
+        end = time.perf_counter() if end is None else end
+        _spans.append((name, start - STARTED, end - start, threading.current_thread().name))
+
+
+def count(name: str, n: int = 1):
+    """Adds n to the counter name"""
+    if ENABLED:
+        _counters[name] += n
+
+
+def report(file=None):
+    """Writes what was recorded to file, stderr by default"""
+    file = file or sys.stderr
+
+    if _mode == "cprofile":
+        import pstats
+
+        _profile.disable()
+        pstats.Stats(_profile, stream=file).sort_stats("cumulative").print_stats(40)
+
+    if _mode == "json":
+        trace = {
+            "spans": [
+                {"name": path, "start": start, "duration": duration, "thread": thread}
+                for path, start, duration, thread in _spans
+            ],
+            "counters": dict(_counters),
+        }
+        file.write(json.dumps(trace))
+        file.write("\n")
+        return
+
+    totals = {}
+    for path, _, duration, _ in _spans:
+        calls, total = totals.get(path, (0, 0.0))
+        totals[path] = (calls + 1, total + duration)
+
+    file.write(f"{'span':<60} {'calls':>6} {'total ms':>10}\n")
+    for path in sorted(totals):
+        calls, total = totals[path]
+        depth = path.count("/")
+        name = "  " * depth + path.rsplit("/", 1)[-1]
+        file.write(f"{name:<60} {calls:>6} {total * 1000:>10.2f}\n")
+    for name in sorted(_counters):
+        file.write(f"{name:<60} {_counters[name]:>17}\n")
+    file.write(f"{'process':<60} {'':>6} {(time.perf_counter() - STARTED) * 1000:>10.2f}\n")
+
+
+if os.environ.get("WAYBAR_CALENDAR_PROFILE"):
+    enable(os.environ["WAYBAR_CALENDAR_PROFILE"])
@@ -0,0 +1,277 @@
+"""Recurring events are stored once with their rules and expanded into events rows only for the windows that are
+read. The expanded instances are cached in the events table, tagged with their recurrence_id, and regenerated when
+the recurrence changes, so storage depends on what is viewed rather than how far ahead calendars are synced"""
+import sys, time
+from datetime import datetime, date, timedelta, timezone
+from typing import Iterable, Optional, Union
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from cal import (
+    Event,
+    Recurrence,
+    WriteResult,
+    adapt_datetime,
+    chunks,
+    connect,
+    convert_datetime,
+    event_row,
+    row_hash,
+    to_epoch,
+)
+from snapshot import write_snapshot
+from timezones import DAY
+import profiling
+
+# Whenever recurrences are written they are expanded this far ahead, so the snapshot includes their instances
+EXPAND_AHEAD = timedelta(days=100)
+
+# Recurrences whose expanded range doesn't cover the window, or that changed since they were expanded
+STALE_QUERY = """SELECT
+recurrences.id, calendar_id, recurrences.start, recurrences.end, name, description, time_zone, rules, recurrences.hash,
+expansions.start_utc, expansions.end_utc, expansions.hash
+FROM recurrences
+LEFT JOIN expansions ON expansions.recurrence_id = recurrences.id
+WHERE recurrences.start_utc <= :end AND (last_utc IS NULL OR last_utc >= :start)
+AND (expansions.recurrence_id IS NULL OR expansions.hash != recurrences.hash
+    OR expansions.start_utc > max(:start, recurrences.start_utc)
+    OR expansions.end_utc < min(:end, coalesce(last_utc, :end)))
+"""
+
+
+def get_zone(name: str):
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        return timezone.utc
+
+
+def rule_set(recurrence: Recurrence):
+    # dateutil is only needed once there are recurring events
+    from dateutil.rrule import rrulestr
+
+    if type(recurrence.start) is datetime:
+        dtstart = recurrence.start.astimezone(get_zone(recurrence.time_zone))
+    else:
+        # All day events repeat on naive midnights, matching VALUE=DATE exception dates
+        dtstart = datetime.combine(recurrence.start, datetime.min.time())
+
+    return rrulestr("\n".join(recurrence.rules), dtstart=dtstart, forceset=True, tzids=get_zone)
+
+
+def occurrence_start(recurrence: Recurrence, occurrence: datetime) -> Union[datetime, date]:
+    if type(recurrence.start) is datetime:
+        return occurrence.astimezone(timezone.utc)
+    else:
+        return occurrence.date()
+
+
+def last_start(recurrence: Recurrence) -> Optional[int]:
+    """Epoch of the start of the last instance, or None if the rules repeat forever"""
+    ruleset = rule_set(recurrence)
+    if any(rule._count is None and rule._until is None for rule in ruleset._rrule):
+        return None
+
+    last = None
+    for last in ruleset:
+        pass
+    if last is None:
+        return to_epoch(recurrence.start)
+
+    return to_epoch(occurrence_start(recurrence, last))
+
+
+def instance_id(recurrence_id: str, start: Union[datetime, date]) -> str:
+    """Google's id for an instance of a recurring event, which is also used for changed instances from .ics files"""
+    if type(start) is datetime:
+        return f"{recurrence_id}_{start.astimezone(timezone.utc):%Y%m%dT%H%M%SZ}"
+    else:
+        return f"{recurrence_id}_{start:%Y%m%d}"
+
+
+def instances(recurrence: Recurrence, start_utc: int, end_utc: int, skip: Iterable[int] = ()) -> list[Event]:
+    """The instances of a recurrence starting between the epochs start_utc and end_utc, leaving out the instances
+    whose original start is in skip"""
+    ruleset = rule_set(recurrence)
+    duration = recurrence.end - recurrence.start
+    skip = set(skip)
+
+    after = datetime.fromtimestamp(start_utc, timezone.utc)
+    before = datetime.fromtimestamp(end_utc, timezone.utc)
+    if type(recurrence.start) is not datetime:
+        after = after.replace(tzinfo=None)
+        before = before.replace(tzinfo=None)
+
+    events = []
+    for occurrence in ruleset.between(after, before, inc=True):
+        start = occurrence_start(recurrence, occurrence)
+        if to_epoch(start) in skip:
+            continue
+        events.append(
+            Event(
+                id=instance_id(recurrence.id, start),
+                calendar_id=recurrence.calendar_id,
+                start=start,
+                end=start + duration,
+                name=recurrence.name,
+                description=recurrence.description,
+            )
+        )
+
+    return events
+
+
+def _to_recurrence(row) -> Recurrence:
+    id, calendar_id, start, end, name, description, time_zone, rules = row
+    return Recurrence(
+        id=id,
+        calendar_id=calendar_id,
+        start=convert_datetime(start.encode()),
+        end=convert_datetime(end.encode()),
+        name=name,
+        description=description,
+        time_zone=time_zone,
+        rules=tuple(rules.split("\n")),
+    )
+
+
+def expand(con, start_utc: int, end_utc: int) -> int:
+    """Expands every recurrence that isn't expanded over the epochs [start_utc, end_utc] yet, using the writable
+    connection con inside the caller's transaction. Returns the number of instances added"""
+    added = 0
+    for row in con.execute(STALE_QUERY, {"start": start_utc, "end": end_utc}).fetchall():
+        recurrence = _to_recurrence(row[:8])
+        recurrence_hash, expanded_start, expanded_end, expanded_hash = row[8:]
+
+        if expanded_hash != recurrence_hash:
+            # New or changed since it was last expanded
+            con.execute("DELETE FROM events WHERE recurrence_id = ?", (recurrence.id,))
+            ranges = [(start_utc, end_utc)]
+            expanded = (start_utc, end_utc)
+        else:
+            ranges = []
+            if start_utc < expanded_start:
+                ranges.append((start_utc, expanded_start - 1))
+            if end_utc > expanded_end:
+                ranges.append((expanded_end + 1, end_utc))
+            expanded = (min(start_utc, expanded_start), max(end_utc, expanded_end))
+
+        skip = [
+            row[0]
+            for row in con.execute(
+                "SELECT start_utc FROM recurrence_exceptions WHERE recurrence_id = ?", (recurrence.id,)
+            )
+        ]
+
+        try:
+            events = [event for range in ranges for event in instances(recurrence, *range, skip)]
+        except (ValueError, TypeError) as e:
+            # Rules dateutil can't handle are recorded as expanded so they aren't retried on every read
+            print(f"Couldn't expand recurring event {recurrence.id}: {e}", file=sys.stderr)
+            events = []
+
+        # rowcount leaves out the rows changed by triggers, unlike con.total_changes
+        added += con.executemany(
+            "INSERT OR IGNORE INTO events (id, calendar_id, start, end, name, description, start_utc, end_utc, all_day, hash, recurrence_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [(*event_row(event), recurrence.id) for event in events],
+        ).rowcount
+
+        con.execute(
+            "INSERT OR REPLACE INTO expansions (recurrence_id, start_utc, end_utc, hash) VALUES (?, ?, ?, ?)",
+            (recurrence.id, *expanded, recurrence_hash),
+        )
+
+    return added
+
+
+def expansion_range(start_utc: int, end_utc: int) -> tuple[int, int]:
+    """The epochs to expand over to cover start_utc to end_utc: from the start of the day, to EXPAND_AHEAD past the
+    end of the day. Windows that slide along with the time, such as the next 100 days, then stay covered and are
+    only read, instead of expanding every recurrence a little further on every read"""
+    return start_utc - start_utc % DAY, end_utc - end_utc % DAY + DAY + int(EXPAND_AHEAD.total_seconds())
+
+
+def ensure_expanded(start_utc: int, end_utc: int):
+    """Makes sure the events table holds every recurring instance starting between the epochs start_utc and
+    end_utc. Only takes the write lock when something needs expanding"""
+    if connect(readonly=True).execute(STALE_QUERY + "LIMIT 1", {"start": start_utc, "end": end_utc}).fetchone() is None:
+        return
+
+    con = connect()
+    with con, profiling.span("expand recurrences"):
+        # Take the write lock before expand reads what is stale, in case another reader is expanding too
+        con.execute("BEGIN IMMEDIATE")
+        if expand(con, *expansion_range(start_utc, end_utc)):
+            write_snapshot(con)
+
+
+def write(
+    recurrences: dict[str, Recurrence],
+    exceptions: Iterable[tuple[str, Union[datetime, date]]] = (),
+    deleted: Iterable[str] = (),
+    replace_calendars: Iterable[str] = (),
+) -> WriteResult:
+    """write the recurrences that differ from the sqlite3 database and delete those with ids in deleted, along with
+    any of replace_calendars that aren't in recurrences. exceptions are (recurrence id, original start) of instances
+    that were moved or cancelled, which are no longer expanded. Changed recurrences are expanded again straight away
+    over the next EXPAND_AHEAD"""
+    con = connect()
+
+    rows = {}
+    for recurrence in recurrences.values():
+        row = (
+            *(adapt_datetime(value) if isinstance(value, date) else value for value in recurrence[:7]),
+            "\n".join(recurrence.rules),
+        )
+        try:
+            last_utc = last_start(recurrence)
+        except (ValueError, TypeError):
+            last_utc = None
+        rows[recurrence.id] = (*row, to_epoch(recurrence.start), last_utc, row_hash(row))
+
+    with con:
+        # Take the write lock before comparing, so another writer can't insert the same ids in between
+        con.execute("BEGIN IMMEDIATE")
+        stored = {}
+        for ids in chunks(list(rows)):
+            stored.update(
+                con.execute(f"SELECT id, hash FROM recurrences WHERE id IN ({', '.join('?' * len(ids))})", ids)
+            )
+
+        new = [row for id, row in rows.items() if id not in stored]
+        changed = [row for id, row in rows.items() if id in stored and stored[id] != row[-1]]
+
+        # The expansions hash no longer matches, so the instances of changed recurrences are regenerated
+        con.executemany(
+            "INSERT OR REPLACE INTO recurrences (id, calendar_id, start, end, name, description, time_zone, rules, start_utc, last_utc, hash) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            new + changed,
+        )
+
+        exceptions = [(id, to_epoch(start)) for id, start in exceptions]
+        con.executemany(
+            "INSERT OR IGNORE INTO recurrence_exceptions (recurrence_id, start_utc) VALUES (?, ?)", exceptions
+        )
+        removed = con.executemany("DELETE FROM events WHERE recurrence_id = ? AND start_utc = ?", exceptions).rowcount
+
+        deleted = set(deleted) - rows.keys()
+        for calendar_id in replace_calendars:
+            cur = con.execute("SELECT id FROM recurrences WHERE calendar_id = ?", (calendar_id,))
+            deleted.update(id for id, in cur if id not in rows)
+
+        deleted_count = con.executemany("DELETE FROM recurrences WHERE id = ?", ((id,) for id in deleted)).rowcount
+        removed += con.executemany("DELETE FROM events WHERE recurrence_id = ?", ((id,) for id in deleted)).rowcount
+        for table in ("expansions", "recurrence_exceptions"):
+            con.executemany(f"DELETE FROM {table} WHERE recurrence_id = ?", ((id,) for id in deleted))
+
+        now = int(time.time())
+        added = expand(con, *expansion_range(now - DAY, now))
+
+        # Most incremental syncs change nothing, and then nothing is written
+        if new or changed or deleted_count or removed or added:
+            write_snapshot(con)
+
+    return WriteResult(
+        inserted=len(new),
+        updated=len(changed),
+        deleted=deleted_count,
+        unchanged=len(rows) - len(new) - len(changed),
+    )
@@ -0,0 +1,194 @@
+"""Answers the widget, the GTK app and scripts over a Unix socket (see ipc.py) from events kept in memory. The events
+of active calendars from a day ago to HOT_DAYS ahead are held in an EventStore, read again only when change_log shows
+the database changed or the window has moved on, so however many clients poll, cal.db is read once.
+
+    python server.py
+
+Methods:
+    next    tz, at        the events happening at at (default now) and the next one to start after it
+    agenda  start, end    the events overlapping start to end, in order of start, at most limit if given
+    search  query         Events.search results, best first, at most limit, within days either side of now if given
+"""
+import argparse, json, os, signal, socket, socketserver, sys, threading, time, traceback
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from cal import SEARCH_LIMIT, Events
+from change_log import ChangeTracker
+from event_store import EventStore
+from ipc import event_row, socket_path
+from timezones import DAY
+
+# Days ahead of now that are kept in memory
+HOT_DAYS = 100
+# Seconds between checks for changes to the database
+POLL_INTERVAL = 1.0
+# The window is read again once it starts this many seconds before a day ago
+SLIDE_AFTER = 60 * 60
+
+
+def parse_time(value: Optional[str]) -> datetime:
+    """An ISO 8601 time from a request, taken as UTC without an offset, or now"""
+    if value is None:
+        return datetime.now(timezone.utc)
+    parsed = datetime.fromisoformat(value)
+    return parsed if parsed.tzinfo is not None else parsed.replace(tzinfo=timezone.utc)
+
+
+class HotWindow:
+    """The EventStore served from, read by a single thread so its ChangeTracker stays on one connection. Requests on
+    other threads take the current store, which is replaced whole and never changed"""
+
+    def __init__(self):
+        self.store = None
+        self.start = None
+        self.end = None
+        self._ready = threading.Event()
+
+    def read(self):
+        now = datetime.now(timezone.utc)
+        start = now - timedelta(seconds=DAY)
+        end = now + timedelta(HOT_DAYS)
+        store = EventStore.read(start, end, overlapping=True)
+        self.store, self.start, self.end = store, start, end
+
+    def run(self):
+        # Changes made while the first read runs are read again on the first poll
+        tracker = ChangeTracker()
+        stale = True
+        while True:
+            if stale:
+                try:
+                    self.read()
+                except Exception:
+                    # Requests read the database themselves until a read works
+                    traceback.print_exc()
+                self._ready.set()
+
+            time.sleep(POLL_INTERVAL)
+            changes = tracker.poll()
+            stale = (
+                changes.events
+                or changes.calendars
+                or not changes.complete
+                or self.start is None
+                or datetime.now(timezone.utc) - self.start > timedelta(seconds=DAY + SLIDE_AFTER)
+            )
+
+    def holding(self, start: datetime, end: datetime) -> Optional[EventStore]:
+        """The events in memory if they include every event overlapping start to end, otherwise None"""
+        self._ready.wait()
+        store, window_start, window_end = self.store, self.start, self.end
+        if store is None or not (window_start <= start and end <= window_end):
+            return None
+        return store
+
+
+def next_events(window: HotWindow, tz: str = "UTC", at: Optional[str] = None) -> dict:
+    at = parse_time(at)
+    # The next event may be after the window ends, as long as the window holds everything happening at at
+    store = window.holding(at, at)
+    if store is None:
+        store = EventStore.read(at, at + timedelta(HOT_DAYS), overlapping=True)
+    following = store.next_after(at, tz)
+    return {
+        "current": [event_row(event) for event in store.active_at(at, tz)],
+        "next": None if following is None else event_row(following),
+    }
+
+
+def agenda(window: HotWindow, start: str, end: str, tz: str = "UTC", limit: int = 0) -> dict:
+    start, end = parse_time(start), parse_time(end)
+    store = window.holding(start, end)
+    if store is None:
+        store = EventStore.read(start, end, overlapping=True)
+    events = store.overlapping(start, end, tz)
+    if limit:
+        events = events[:limit]
+    return {"events": [event_row(event) for event in events]}
+
+
+def search(window: HotWindow, query: str, limit: int = SEARCH_LIMIT, days: Optional[int] = None) -> dict:
+    search_window = None
+    if days is not None:
+        now = datetime.now(timezone.utc)
+        search_window = (now - timedelta(days), now + timedelta(days))
+    return {"events": [event_row(event) for event in Events.search(query, search_window, limit).values()]}
+
+
+METHODS = {"next": next_events, "agenda": agenda, "search": search}
+
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                method = METHODS.get(request.pop("method", None))
+                if method is None:
+                    raise ValueError(f"unknown method, expected one of {', '.join(METHODS)}")
+                response = {"result": method(self.server.window, **request)}
+            except Exception as e:
+                response = {"error": f"{type(e).__name__}: {e}"}
+
+            self.wfile.write(json.dumps(response).encode())
+            self.wfile.write(b"\n")
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """A thread per connection, so clients that stay connected, like the widget in --follow mode, don't hold up
+    the rest"""
+
+    daemon_threads = True
+
+    def __init__(self, path: str, window: HotWindow):
+        self.window = window
+        # Only this user can connect
+        umask = os.umask(0o077)
+        try:
+            super().__init__(path, Handler)
+        finally:
+            os.umask(umask)
+
+
+def remove_stale_socket(path: str):
+    """Removes a socket left behind by a server that didn't exit cleanly. Exits if a server is still listening"""
+    if not os.path.exists(path):
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except OSError:
+        os.remove(path)
+    else:
+        sys.exit(f"A server is already listening on {path}")
+    finally:
+        probe.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve calendar queries over a Unix socket")
+    parser.add_argument("--socket", default=None, help="path of the socket, see ipc.socket_path")
+    args = parser.parse_args(argv)
+
+    path = args.socket or socket_path()
+    remove_stale_socket(path)
+
+    window = HotWindow()
+    threading.Thread(target=window.run, name="hot window", daemon=True).start()
+
+    # Exit through the finally below, so the socket is removed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    server = Server(path, window)
+    print(f"Listening on {path}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
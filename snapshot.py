@@ -0,0 +1,91 @@
+"""A small precomputed list of upcoming events, written whenever the calendars or events change.
+Reading it is a single row lookup, so the widget can skip the events query entirely"""
+import json, sqlite3, time
+from datetime import datetime, timezone
+
+from intervals import in_progress
+
+# Number of upcoming events kept in the snapshot
+SNAPSHOT_SIZE = 20
+# A snapshot older than this many seconds is ignored and the events table is queried instead
+SNAPSHOT_MAX_AGE = 6 * 60 * 60
+
+
+def parse_datetime(string):
+    """Same conversion as the datetime converter in cal: dates stay dates"""
+    datetime_obj = datetime.fromisoformat(string)
+    if len(string) == 10:
+        return datetime_obj.date()
+    else:
+        return datetime_obj
+
+
+def write_snapshot(con, size: int = SNAPSHOT_SIZE):
+    """Stores the next `size` events from active calendars, including those still in progress, in the single row
+    snapshot table.
+    Runs in the caller's transaction, so the snapshot changes together with the events it was built from"""
+    now = time.time()
+    # Start a day back so the snapshot still covers "today" in any local timezone
+    since = int(now) - 24 * 60 * 60
+
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS snapshot (id INTEGER PRIMARY KEY CHECK (id = 0), written INTEGER, events TEXT);"
+    )
+
+    select = """SELECT events.id, calendar_id, start, end, events.name, events.description
+        FROM events
+        INNER JOIN calendars ON events.calendar_id = calendars.id
+        """
+    rows = con.execute(
+        f"{select} WHERE {in_progress(con)} AND active = 1 ORDER BY start_utc LIMIT :size",
+        {"at": since, "size": size},
+    ).fetchall()
+    rows += con.execute(
+        f"{select} WHERE start_utc >= :at AND active = 1 ORDER BY start_utc LIMIT :size",
+        {"at": since, "size": size - len(rows)},
+    ).fetchall()
+
+    con.execute(
+        "INSERT OR REPLACE INTO snapshot (id, written, events) VALUES (0, ?, ?)",
+        (int(now), json.dumps({"size": size, "events": rows})),
+    )
+
+
+def read_snapshot(con, start: datetime, end: datetime, max_age: int = SNAPSHOT_MAX_AGE):
+    """Returns the snapshot events overlapping start to end as tuples in the field order of cal.Event.
+    Returns None when the snapshot is missing, stale or has run out of events, in which case the caller
+    should fall back to querying the events table"""
+    try:
+        row = con.execute("SELECT written, events FROM snapshot WHERE id = 0").fetchone()
+    except sqlite3.OperationalError:
+        # Nothing has been synced yet
+        return None
+
+    if row is None or time.time() - row[0] > max_age:
+        return None
+
+    snapshot = json.loads(row[1])
+    rows = snapshot["events"]
+
+    events = []
+    for id, calendar_id, event_start, event_end, name, description in rows:
+        event_start = parse_datetime(event_start)
+        event_end = parse_datetime(event_end)
+        if type(event_start) is datetime and not (event_start <= end and event_end > start):
+            continue
+        # All day events end on the day after their last
+        if type(event_start) is not datetime and not (event_start <= end.date() and event_end > start.date()):
+            continue
+        events.append((id, calendar_id, event_start, event_end, name, description))
+
+    # A full snapshot that has been used up may be hiding later events, including the next one to start
+    if len(rows) == snapshot["size"]:
+        if not events:
+            return None
+        last_start = parse_datetime(rows[-1][2])
+        if type(last_start) is not datetime:
+            last_start = datetime.combine(last_start, datetime.min.time(), tzinfo=timezone.utc)
+        if last_start.timestamp() <= time.time():
+            return None
+
+    return events
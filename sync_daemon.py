@@ -0,0 +1,125 @@
+"""Keeps cal.db fresh in the background. Each calendar is synced on its own interval, which shortens while the
+calendar keeps changing and grows while it stays quiet, and failed syncs back off exponentially"""
+import sys, time, random, heapq
+from typing import NamedTuple
+
+from googleapiclient.errors import HttpError
+
+from cal import Calendars
+import google_calendar
+
+# Seconds between syncs of one calendar
+MIN_INTERVAL = 5 * 60
+MAX_INTERVAL = 6 * 60 * 60
+START_INTERVAL = 15 * 60
+
+# Seconds between refreshes of the calendar list
+CALENDARS_INTERVAL = 6 * 60 * 60
+
+# Backoff after a failed sync is BACKOFF_BASE * 2 ** (failures - 1) seconds, up to MAX_BACKOFF
+BACKOFF_BASE = 60
+MAX_BACKOFF = 60 * 60
+
+
+class Schedule(NamedTuple):
+    """When a calendar is next synced"""
+
+    interval: float = START_INTERVAL
+    failures: int = 0
+
+
+def next_interval(schedule: Schedule, changes: int) -> Schedule:
+    """Halves the interval of a calendar that changed and doubles it for one that didn't"""
+    if changes:
+        interval = max(MIN_INTERVAL, schedule.interval / 2)
+    else:
+        interval = min(MAX_INTERVAL, schedule.interval * 2)
+
+    return Schedule(interval=interval, failures=0)
+
+
+def backoff(schedule: Schedule) -> tuple[Schedule, float]:
+    """Returns the schedule after another failure and the delay before retrying, with jitter so calendars that
+    failed together don't all retry together"""
+    failures = schedule.failures + 1
+    delay = min(MAX_BACKOFF, BACKOFF_BASE * 2 ** (failures - 1))
+    delay *= random.uniform(0.75, 1.25)
+
+    return schedule._replace(failures=failures), delay
+
+
+def is_quota_error(error: HttpError) -> bool:
+    return error.resp.status == 429 or (error.resp.status == 403 and b"ateLimitExceeded" in error.content)
+
+
+def run(session=None):
+    """Syncs forever. Calendars toggled in the GTK app are picked up on the next wake up"""
+    session = session or google_calendar.getSession()
+
+    schedules = {}
+    # (due time, calendar id) of every active calendar
+    queue = []
+    calendars_due = 0
+
+    while True:
+        now = time.monotonic()
+
+        if now >= calendars_due:
+            try:
+                google_calendar.sync_calendars(session)
+                calendars_due = now + CALENDARS_INTERVAL
+            except Exception as e:
+                print(f"Calendar list sync failed: {e}", file=sys.stderr)
+                calendars_due = now + BACKOFF_BASE
+
+        active = Calendars().active()
+
+        # Newly active calendars are synced straight away, deactivated ones are dropped
+        for id in active.keys() - schedules.keys():
+            schedules[id] = Schedule()
+            heapq.heappush(queue, (now, id))
+        for id in schedules.keys() - active.keys():
+            del schedules[id]
+        queue = [(due, id) for due, id in queue if id in schedules]
+        heapq.heapify(queue)
+
+        due_ids = []
+        while queue and queue[0][0] <= now:
+            due_ids.append(heapq.heappop(queue)[1])
+
+        if due_ids:
+            calendars = Calendars()
+            try:
+                changes = google_calendar.sync_events(calendars, session=session, calendar_ids=due_ids)
+                errors = {}
+            except google_calendar.SyncFailed as e:
+                # The other calendars were synced, so only the ones that failed back off
+                changes, errors = e.changes, e.errors
+            except Exception as e:
+                changes, errors = {}, dict.fromkeys(due_ids, e)
+
+            for id, error in errors.items():
+                if isinstance(error, HttpError) and is_quota_error(error):
+                    print(f"Sync of {id} hit the API quota, backing off", file=sys.stderr)
+                else:
+                    print(f"Sync of {id} failed: {error}", file=sys.stderr)
+
+            for id in due_ids:
+                if id in errors:
+                    schedules[id], delay = backoff(schedules[id])
+                    heapq.heappush(queue, (now + delay, id))
+                else:
+                    schedules[id] = next_interval(schedules[id], changes.get(id, 0))
+                    heapq.heappush(queue, (now + schedules[id].interval, id))
+
+        wake = calendars_due
+        if queue:
+            wake = min(wake, queue[0][0])
+        time.sleep(max(1, min(wake - time.monotonic(), MIN_INTERVAL)))
+
+
+if __name__ == "__main__":
+    try:
+        run()
+    except KeyboardInterrupt:
+        pass
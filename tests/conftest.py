@@ -0,0 +1,18 @@
+import os, sys
+
+import pytest
+
+# The modules live at the top of the repository rather than in a package
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+
+import db
+
+
+@pytest.fixture
+def database(tmp_path):
+    """Points db at a new database for the test"""
+    db.close()
+    db.DB_PATH = str(tmp_path / "cal.db")
+    yield db.DB_PATH
+    db.close()
@@ -0,0 +1,115 @@
+"""Events.write and Calendars.write, which only write what differs from the database"""
+import threading
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import db
+from cal import Calendar, Calendars, Event, Events, WriteResult
+
+pytestmark = pytest.mark.usefixtures("database")
+
+START = datetime(2026, 3, 2, 9, tzinfo=timezone.utc)
+
+
+def event(i: int, name: str = None) -> Event:
+    start = START + timedelta(hours=i)
+    return Event(f"event{i}", "work", start, start + timedelta(minutes=30), name or f"Event {i}")
+
+
+def events(ids, **kwargs) -> Events:
+    return Events({f"event{i}": event(i, **kwargs) for i in ids})
+
+
+def stored():
+    """Names of the stored events by id"""
+    return dict(db.connect().execute("SELECT id, name FROM events"))
+
+
+def test_write_counts():
+    assert events(range(5)).write() == WriteResult(inserted=5)
+
+    batch = events(range(3, 7))
+    batch["event4"] = event(4, "Renamed")
+    assert batch.write(deleted=["event0", "event1", "missing"]) == WriteResult(
+        inserted=2, updated=1, deleted=2, unchanged=1
+    )
+    assert stored() == {
+        "event2": "Event 2",
+        "event3": "Event 3",
+        "event4": "Renamed",
+        "event5": "Event 5",
+        "event6": "Event 6",
+    }
+
+    assert batch.write() == WriteResult(unchanged=4)
+
+
+def test_write_replaces_calendars():
+    events(range(5)).write()
+
+    result = events(range(2, 4)).write(replace_calendars=["work"])
+
+    assert result == WriteResult(deleted=3, unchanged=2)
+    assert stored().keys() == {"event2", "event3"}
+
+
+def test_write_replaces_calendars_in_window():
+    events(range(5)).write()
+
+    window = (START + timedelta(hours=2), START + timedelta(hours=10))
+    result = events([2]).write(replace_calendars=["work"], window=window)
+
+    assert result == WriteResult(deleted=2, unchanged=1)
+    assert stored().keys() == {"event0", "event1", "event2"}
+
+
+def test_concurrent_writes_of_the_same_events():
+    results = []
+    errors = []
+
+    def write(offset):
+        try:
+            for i in range(10):
+                results.append(events(range(offset + i * 5, offset + i * 5 + 20)).write())
+        except Exception as e:
+            errors.append(e)
+        finally:
+            db.close()
+
+    # Every batch overlaps the batches of the other threads
+    threads = [threading.Thread(target=write, args=(offset,)) for offset in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert sum(result.inserted for result in results) == len(stored()) == 3 + 9 * 5 + 20
+
+
+def test_calendars_write_counts():
+    work = Calendar("work", "Work", time_zone="UTC", active=True)
+    home = Calendar("home", "Home", time_zone="UTC", active=True)
+    assert Calendars({"work": work, "home": home}).write() == WriteResult(inserted=2)
+
+    calendars = Calendars()
+    calendars["home"] = home._replace(active=False)
+    assert calendars.write() == WriteResult(updated=1, unchanged=1)
+
+
+def test_window_with_overlapping():
+    Calendars({"work": Calendar("work", "Work", time_zone="UTC", active=True)}).write()
+    conference = Event("conference", "work", START - timedelta(days=3), START + timedelta(days=2), "Conference")
+    finished = Event("finished", "work", START - timedelta(days=3), START - timedelta(days=2), "Finished")
+    Events({"conference": conference, "finished": finished, **events(range(3))}).write()
+
+    window = (START, START + timedelta(days=1))
+    assert list(Events(window=window)) == ["event0", "event1", "event2"]
+    assert list(Events(window=window, overlapping=True)) == ["conference", "event0", "event1", "event2"]
+    assert [event.id for event in Events.iter_window(*window, calendars=["work"], batch=2, overlapping=True)] == [
+        "conference",
+        "event0",
+        "event1",
+        "event2",
+    ]
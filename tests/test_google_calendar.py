@@ -0,0 +1,109 @@
+"""sync_events against benchmarks.fake_google, a local stand-in for the Calendar API service object"""
+import pytest
+
+import db
+import google_calendar
+from benchmarks.fake_google import FakeService, FakeSession
+from cal import Calendars, Events, read_sync_tokens, write_sync_tokens
+
+pytestmark = pytest.mark.usefixtures("database")
+
+
+@pytest.fixture
+def writes(monkeypatch):
+    """The number of events in each Events.write"""
+    sizes = []
+    write = Events.write
+
+    def counted(self, *args, **kwargs):
+        sizes.append(len(self))
+        return write(self, *args, **kwargs)
+
+    monkeypatch.setattr(Events, "write", counted)
+    return sizes
+
+
+def sync(service):
+    session = FakeSession(service)
+    google_calendar.sync_calendars(session)
+    return google_calendar.sync_events(Calendars(), session=session)
+
+
+def stored():
+    """Names of the stored events by id"""
+    return dict(db.connect().execute("SELECT id, name FROM events"))
+
+
+def test_calendars_fetched_concurrently_and_written_once(writes):
+    service = FakeService(calendars=6, events=20, latency=0.05)
+
+    changes = sync(service)
+
+    assert service.most_active > 1
+    assert changes == {id: 20 for id in service.calendars}
+    assert writes == [6 * 20]
+    assert stored().keys() == {item["id"] for calendar in service.calendars.values() for item in calendar["events"]}
+
+
+def test_every_page_is_fetched(monkeypatch):
+    monkeypatch.setattr(google_calendar, "EVENT_PAGE_SIZE", 7)
+    service = FakeService(calendars=2, events=20, latency=0)
+
+    sync(service)
+
+    # The calendar list, then 3 pages of each calendar
+    assert service.requests == 1 + 2 * 3
+    assert len(stored()) == 2 * 20
+
+
+def test_cancelled_events_are_removed():
+    service = FakeService(calendars=3, events=10, latency=0)
+    sync(service)
+
+    service.change(2)
+    changes = sync(service)
+
+    events = stored()
+    for id, calendar in service.calendars.items():
+        cancelled = calendar["events"][0]["id"]
+        assert cancelled not in events
+        # An event renamed and then cancelled in the same changes is only counted once
+        assert changes[id] == len({item["id"] for item in calendar["changes"]["0"]})
+        for item in calendar["events"][1:]:
+            assert events[item["id"]] == item["summary"]
+    assert len(events) == 3 * 9
+    assert read_sync_tokens() == {id: "1" for id in service.calendars}
+
+
+def test_expired_sync_token_falls_back_to_a_full_sync(writes):
+    service = FakeService(calendars=2, events=10, latency=0)
+    sync(service)
+
+    # An event deleted upstream while the token was expired is only noticed by the full sync
+    expired, current = service.calendars
+    removed = service.calendars[expired]["events"].pop()
+    write_sync_tokens({expired: "expired"})
+    writes.clear()
+    changes = sync(service)
+
+    assert changes == {expired: 9, current: 0}
+    assert writes == [9]
+    events = stored()
+    assert removed["id"] not in events
+    assert len(events) == 9 + 10
+    assert read_sync_tokens() == {expired: "0", current: "0"}
+
+
+def test_failed_calendar_does_not_stop_the_others():
+    service = FakeService(calendars=3, events=10, latency=0)
+    missing, *working = service.calendars
+    service.missing.add(missing)
+
+    with pytest.raises(google_calendar.SyncFailed) as failed:
+        sync(service)
+
+    assert failed.value.errors.keys() == {missing}
+    assert failed.value.errors[missing].resp.status == 404
+    assert failed.value.changes == {id: 10 for id in working}
+    assert len(stored()) == 2 * 10
+    assert read_sync_tokens() == {id: "0" for id in working}
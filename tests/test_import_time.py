@@ -0,0 +1,68 @@
+"""The widget is started by waybar every 30 seconds, so its imports are most of its cost. Runs check_db.py under
+python -X importtime against a database with a snapshot and checks what it imports and how long that takes"""
+import os, subprocess, sys
+
+import pytest
+
+from conftest import ROOT
+
+# Microseconds the widget's own imports may take, on top of the interpreter's startup
+IMPORT_BUDGET = 40_000
+# Only needed when the snapshot can't be used, or by the GTK app and sync
+NOT_IMPORTED = ("cal", "pytz", "dateutil", "googleapiclient")
+
+WRITE_EVENTS = """
+from datetime import datetime, timedelta, timezone
+from cal import Calendar, Calendars, Event, Events
+Calendars({"work": Calendar("work", "Work", time_zone="UTC", active=True)}).write()
+now = datetime.now(timezone.utc).replace(microsecond=0)
+Events(
+    {
+        f"event{i}": Event(f"event{i}", "work", now + timedelta(hours=i), now + timedelta(hours=i, minutes=30), f"Event {i}")
+        for i in range(-2, 40)
+    }
+).write()
+"""
+
+
+def import_times(args, env) -> tuple[dict[str, int], set[str]]:
+    """Cumulative microseconds of each module imported at the top level, by name, and the names of every module
+    imported"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", *args], cwd=ROOT, env=env, capture_output=True, text=True, check=True
+    )
+    times = {}
+    imported = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        imported.add(name.strip())
+        # Modules imported by other modules are indented under them
+        if not name.startswith("  "):
+            times[name.strip()] = int(cumulative)
+    return times, imported
+
+
+@pytest.fixture
+def env(tmp_path):
+    env = dict(os.environ)
+    env.pop("WAYBAR_CALENDAR_PROFILE", None)
+    env["WAYBAR_CALENDAR_DB"] = str(tmp_path / "cal.db")
+    # No server, so the widget reads the snapshot
+    env["WAYBAR_CALENDAR_SOCKET"] = str(tmp_path / "missing.sock")
+    subprocess.run([sys.executable, "-c", WRITE_EVENTS], cwd=ROOT, env=env, check=True)
+    return env
+
+
+def test_widget_import_time(env):
+    startup, _ = import_times(["-c", "pass"], env)
+    # The least of a few runs, so a busy machine doesn't fail the test
+    runs = [import_times(["check_db.py"], env) for _ in range(3)]
+
+    _, imported = runs[0]
+    for name in NOT_IMPORTED:
+        assert not any(module == name or module.startswith(f"{name}.") for module in imported), f"imported {name}"
+
+    widget = min(sum(time for name, time in times.items() if name not in startup) for times, _ in runs)
+    assert widget < IMPORT_BUDGET, f"check_db.py took {widget / 1000:.1f}ms to import, over {IMPORT_BUDGET / 1000}ms"
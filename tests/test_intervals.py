@@ -0,0 +1,110 @@
+"""IntervalIndex and the EventStore queries built on it, checked against brute force"""
+import random
+from datetime import date, datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+import pytest
+
+from cal import Event, to_epoch
+from event_store import EventStore
+from intervals import IntervalIndex
+
+
+def random_intervals(rng: random.Random, count: int) -> list[tuple[int, int]]:
+    """Clustered starts, so there are ties, and lengths from zero to longer than the gaps between starts"""
+    intervals = []
+    for _ in range(count):
+        start = rng.randrange(0, 1000, rng.choice((1, 10)))
+        intervals.append((start, start + rng.choice((0, 1, rng.randrange(100), rng.randrange(1000)))))
+    return intervals
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_interval_index(seed):
+    rng = random.Random(seed)
+    intervals = random_intervals(rng, rng.choice((0, 1, 2, 7, 100, 513)))
+    index = IntervalIndex(intervals)
+
+    for t in range(-5, 1100, 7):
+        assert sorted(index.active_at(t)) == [i for i, (start, end) in enumerate(intervals) if start <= t < end]
+
+        following = [(start, i) for i, (start, _) in enumerate(intervals) if start > t]
+        assert index.next_after(t) == (min(following)[1] if following else None)
+
+        end = t + rng.randrange(50)
+        assert sorted(index.overlapping(t, end)) == [
+            i for i, (start, stop) in enumerate(intervals) if start < end and stop > t
+        ]
+
+
+def test_interval_index_returns_start_order():
+    intervals = [(30, 40), (10, 50), (20, 45)]
+
+    assert IntervalIndex(intervals).active_at(35) == [1, 2, 0]
+
+
+MELBOURNE = ZoneInfo("Australia/Melbourne")
+
+
+def local_bounds(event: Event) -> tuple[int, int]:
+    """All day events run from local midnight to local midnight in Melbourne"""
+    if type(event.start) is datetime:
+        return to_epoch(event.start), to_epoch(event.end)
+    midnight = datetime.min.time()
+    return (
+        to_epoch(datetime.combine(event.start, midnight, tzinfo=MELBOURNE)),
+        to_epoch(datetime.combine(event.end, midnight, tzinfo=MELBOURNE)),
+    )
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_event_store_queries(seed):
+    # Around the end of daylight saving in Melbourne on 5 April 2026
+    rng = random.Random(seed)
+    first = datetime(2026, 3, 30, tzinfo=timezone.utc)
+    events = []
+    for i in range(200):
+        if rng.random() < 0.3:
+            day = first.date() + timedelta(rng.randrange(14))
+            events.append(Event(f"event{i}", "work", day, day + timedelta(rng.randint(1, 3)), f"All day {i}"))
+        else:
+            start = first + timedelta(minutes=15 * rng.randrange(14 * 96))
+            end = start + timedelta(minutes=15 * rng.randint(1, 40))
+            events.append(Event(f"event{i}", "work", start, end, f"Timed {i}"))
+    store = EventStore.from_events(events)
+    positions = {event.id: i for i, event in enumerate(store)}
+    bounds = {event.id: local_bounds(event) for event in events}
+
+    for minutes in range(-60, 16 * 24 * 60, 97):
+        t = first + timedelta(minutes=minutes)
+        seconds = to_epoch(t)
+
+        active = [event.id for event in store.active_at(t, "Australia/Melbourne")]
+        assert sorted(active) == sorted(id for id, (start, end) in bounds.items() if start <= seconds < end)
+
+        end = t + timedelta(hours=rng.randrange(48))
+        overlapping = [event.id for event in store.overlapping(t, end, "Australia/Melbourne")]
+        assert sorted(overlapping) == sorted(
+            id for id, (start, stop) in bounds.items() if start < to_epoch(end) and stop > seconds
+        )
+
+        following = [(start, positions[id], id) for id, (start, _) in bounds.items() if start > seconds]
+        expected = min(following)[2] if following else None
+        event = store.next_after(t, "Australia/Melbourne")
+        assert (None if event is None else event.id) == expected
+
+
+def test_all_day_event_starts_at_local_midnight():
+    store = EventStore.from_events([Event("holiday", "work", date(2026, 3, 10), date(2026, 3, 11), "Holiday")])
+
+    def active(hour: int, tz_name: str = "Australia/Melbourne") -> list[str]:
+        # Hours from midnight UTC on the 9th
+        t = datetime(2026, 3, 9, tzinfo=timezone.utc) + timedelta(hours=hour, minutes=30)
+        return [event.id for event in store.active_at(t, tz_name)]
+
+    # Melbourne is 11 hours ahead, so 00:30 on the 10th there is 13:30 on the 9th in UTC
+    assert active(12) == []
+    assert active(13) == ["holiday"]
+    assert active(36) == ["holiday"]
+    assert active(37) == []
+    assert active(36, "UTC") == ["holiday"]
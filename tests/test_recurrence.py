@@ -0,0 +1,148 @@
+"""Recurring events, which are stored once with their rules and expanded into events rows for the windows read"""
+import sqlite3
+from datetime import date, datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+import pytest
+
+import recurrence
+from cal import Event, Events, Recurrence, WriteResult, to_epoch
+
+pytestmark = pytest.mark.usefixtures("database")
+
+LONDON = ZoneInfo("Europe/London")
+# Weekly on Mondays at 9:00 in London, from before the clocks go forward on 29 March 2026 to after
+STANDUP = Recurrence(
+    id="standup",
+    calendar_id="work",
+    start=datetime(2026, 3, 2, 9, tzinfo=LONDON),
+    end=datetime(2026, 3, 2, 9, 30, tzinfo=LONDON),
+    name="Standup",
+    description=None,
+    time_zone="Europe/London",
+    rules=("RRULE:FREQ=WEEKLY;BYDAY=MO",),
+)
+MARCH = (datetime(2026, 3, 1, tzinfo=timezone.utc), datetime(2026, 4, 15, tzinfo=timezone.utc))
+
+
+def instances(window=MARCH) -> dict:
+    return {event.id: event for event in Events.iter_window(*window, calendars=["work"])}
+
+
+class Commits:
+    """Counts commits to the database made by any connection"""
+
+    def __init__(self, path):
+        self._con = sqlite3.connect(path)
+        self._version = self._read()
+
+    def _read(self):
+        return self._con.execute("PRAGMA data_version").fetchone()[0]
+
+    def __call__(self) -> int:
+        version = self._read()
+        commits, self._version = version - self._version, version
+        return commits
+
+
+def test_expands_across_daylight_saving():
+    recurrence.write({"standup": STANDUP})
+
+    starts = [event.start for event in instances().values()]
+
+    assert len(starts) == 7
+    assert all(start.astimezone(LONDON).hour == 9 for start in starts)
+    # 9:00 GMT before the change, 9:00 BST after it
+    assert starts[0] == datetime(2026, 3, 2, 9, tzinfo=timezone.utc)
+    assert starts[-1] == datetime(2026, 4, 13, 8, tzinfo=timezone.utc)
+    assert "standup_20260330T080000Z" in instances()
+
+
+def test_all_day_instances_are_dates():
+    birthday = Recurrence(
+        "birthday", "work", date(2020, 3, 10), date(2020, 3, 11), "Birthday", None, "UTC", ("RRULE:FREQ=YEARLY",)
+    )
+    recurrence.write({"birthday": birthday})
+
+    assert [(event.id, event.start, event.end) for event in instances().values()] == [
+        ("birthday_20260310", date(2026, 3, 10), date(2026, 3, 11))
+    ]
+
+
+def test_exdate_is_skipped():
+    recurrence.write({"standup": STANDUP._replace(rules=(*STANDUP.rules, "EXDATE;TZID=Europe/London:20260316T090000"))})
+
+    assert "standup_20260316T090000Z" not in instances()
+    assert len(instances()) == 6
+
+
+def test_moved_and_cancelled_instances_are_not_expanded():
+    recurrence.write({"standup": STANDUP})
+    instances()
+
+    moved = datetime(2026, 3, 9, 9, tzinfo=timezone.utc)
+    cancelled = datetime(2026, 3, 23, 9, tzinfo=timezone.utc)
+    recurrence.write({"standup": STANDUP}, exceptions=[("standup", moved), ("standup", cancelled)])
+    # Written by the sync that reported the moved instance
+    later = moved + timedelta(hours=3)
+    Events(
+        {
+            "standup_20260309T090000Z": Event(
+                "standup_20260309T090000Z", "work", later, later + timedelta(minutes=30), "Standup (moved)"
+            )
+        }
+    ).write()
+
+    events = instances()
+    assert "standup_20260323T090000Z" not in events
+    assert events["standup_20260309T090000Z"].start == later
+    assert len(events) == 6
+
+
+def test_changed_recurrence_is_expanded_again():
+    recurrence.write({"standup": STANDUP})
+    assert {event.name for event in instances().values()} == {"Standup"}
+
+    result = recurrence.write({"standup": STANDUP._replace(name="Daily standup", rules=("RRULE:FREQ=DAILY;COUNT=3",))})
+
+    assert result == WriteResult(updated=1)
+    assert [(event.id, event.name) for event in instances().values()] == [
+        ("standup_20260302T090000Z", "Daily standup"),
+        ("standup_20260303T090000Z", "Daily standup"),
+        ("standup_20260304T090000Z", "Daily standup"),
+    ]
+
+
+def test_deleted_recurrence_removes_its_instances():
+    recurrence.write({"standup": STANDUP})
+    instances()
+
+    assert recurrence.write({}, deleted=["standup"]) == WriteResult(deleted=1)
+    assert instances() == {}
+
+
+def test_unchanged_write_commits_nothing(database):
+    recurrence.write({"standup": STANDUP})
+    commits = Commits(database)
+
+    assert recurrence.write({"standup": STANDUP}) == WriteResult(unchanged=1)
+    assert commits() == 0
+
+
+def test_sliding_window_is_read_from_the_cache(database):
+    recurrence.write({"standup": STANDUP})
+    start = to_epoch(MARCH[0])
+    commits = Commits(database)
+
+    recurrence.ensure_expanded(start, start + 100 * 24 * 60 * 60)
+    assert commits() == 1
+
+    # The same window a few hours later is already expanded, so reading it writes nothing
+    for hours in range(1, 6):
+        later = start + hours * 60 * 60
+        recurrence.ensure_expanded(later, later + 100 * 24 * 60 * 60)
+    assert commits() == 0
+
+    # A window far past what was expanded is expanded once more
+    recurrence.ensure_expanded(start + 300 * 24 * 60 * 60, start + 400 * 24 * 60 * 60)
+    assert commits() == 1
@@ -0,0 +1,142 @@
+"""Localizes and groups whole result sets at once. A Localizer resolves its zone once and caches the UTC offset
+transitions over the times it has seen, so each event costs a bisect and integer arithmetic instead of a zone lookup
+and strftime. Only uses the standard library so the widget can import it cheaply"""
+from bisect import bisect_right
+from functools import lru_cache
+from datetime import datetime, date, timedelta, timezone
+from typing import Iterable, Union
+from zoneinfo import ZoneInfo
+
+DAY = 24 * 60 * 60
+# Day number 0 is 1970-01-01, a Thursday
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+# Named intervals for Localizer.group, bucketed without strftime
+INTERVALS = ("day", "week", "month")
+
+
+def epoch(obj: datetime) -> int:
+    if obj.tzinfo is None:
+        obj = obj.replace(tzinfo=timezone.utc)
+    return int(obj.timestamp())
+
+
+class Localizer:
+    """Converts UTC datetimes to one time zone. Dates (all day events) are left as they are"""
+
+    def __init__(self, tz_name: str, start: datetime = None, end: datetime = None):
+        self.zone = ZoneInfo(tz_name)
+        # (start, end, transitions, offsets) over the epochs start to end, where the offset in seconds is offsets[i]
+        # from transitions[i - 1] until transitions[i]. Replaced whole, since Localizers are shared between threads
+        self._cache = None
+        self._fixed = {}
+        if start is not None:
+            self.cover(epoch(start), epoch(end or start))
+
+    def _offset_at(self, seconds: int) -> int:
+        utc = datetime.fromtimestamp(seconds, timezone.utc)
+        return int(utc.astimezone(self.zone).utcoffset().total_seconds())
+
+    def cover(self, start: int, end: int) -> tuple:
+        """Caches the transitions between the epochs start and end and returns the cache. Zones change offset at
+        most a few times a year, so the offset is sampled daily and each change is bisected down to the second"""
+        cache = self._cache
+        if cache is not None:
+            if cache[0] <= start and end <= cache[1]:
+                return cache
+            start, end = min(start, cache[0]), max(end, cache[1])
+
+        start -= DAY
+        end += DAY
+        transitions = []
+        offsets = [self._offset_at(start)]
+        previous = start
+        for sample in range(start + DAY, end + DAY, DAY):
+            offset = self._offset_at(sample)
+            if offset == offsets[-1]:
+                previous = sample
+                continue
+
+            low, high = previous, sample
+            while high - low > 1:
+                middle = (low + high) // 2
+                if self._offset_at(middle) == offsets[-1]:
+                    low = middle
+                else:
+                    high = middle
+            transitions.append(high)
+            offsets.append(offset)
+            previous = sample
+
+        self._cache = cache = (start, end, transitions, offsets)
+        return cache
+
+    def offset(self, seconds: int) -> int:
+        """The UTC offset in seconds at the epoch seconds"""
+        cache = self._cache
+        if cache is None or not cache[0] <= seconds <= cache[1]:
+            cache = self.cover(seconds, seconds)
+        _, _, transitions, offsets = cache
+        return offsets[bisect_right(transitions, seconds)]
+
+    def _timezone(self, offset: int) -> timezone:
+        tz = self._fixed.get(offset)
+        if tz is None:
+            tz = self._fixed[offset] = timezone(timedelta(seconds=offset))
+        return tz
+
+    def local(self, obj: Union[datetime, date]) -> Union[datetime, date]:
+        """obj as an aware datetime in local time, or obj itself if it is a date"""
+        if type(obj) is not datetime:
+            return obj
+        return obj.astimezone(self._timezone(self.offset(epoch(obj))))
+
+    def day(self, obj: Union[datetime, date]) -> int:
+        """The local day obj falls on, as days since 1970-01-01"""
+        if type(obj) is not datetime:
+            return obj.toordinal() - EPOCH_ORDINAL
+        seconds = epoch(obj)
+        return (seconds + self.offset(seconds)) // DAY
+
+    def group(self, events: Iterable, interval: str = "day") -> dict:
+        """Splits events by the local day, week (from Monday) or month they start in, keyed by the date that
+        bucket starts on. Any other interval is taken as a strftime format code and the formatted start is the key.
+        Buckets are in the order their first event appears"""
+        events = list(events)
+        if interval not in INTERVALS:
+            split = {}
+            for event in events:
+                split.setdefault(self.local(event.start).strftime(interval), []).append(event)
+            return split
+
+        times = [epoch(event.start) if type(event.start) is datetime else None for event in events]
+        timed = [seconds for seconds in times if seconds is not None]
+        transitions = offsets = None
+        if timed:
+            _, _, transitions, offsets = self.cover(min(timed), max(timed))
+
+        days = {}
+        for event, seconds in zip(events, times):
+            if seconds is None:
+                day = event.start.toordinal() - EPOCH_ORDINAL
+            else:
+                day = (seconds + offsets[bisect_right(transitions, seconds)]) // DAY
+            days.setdefault(day, []).append(event)
+
+        split = {}
+        for day, day_events in days.items():
+            if interval == "day":
+                key = date.fromordinal(day + EPOCH_ORDINAL)
+            elif interval == "week":
+                key = date.fromordinal(day - (day + 3) % 7 + EPOCH_ORDINAL)
+            else:
+                key = date.fromordinal(day + EPOCH_ORDINAL).replace(day=1)
+            split.setdefault(key, []).extend(day_events)
+
+        return split
+
+
+@lru_cache(maxsize=None)
+def get_localizer(tz_name: str) -> Localizer:
+    """A Localizer shared by everything in the process using tz_name"""
+    return Localizer(tz_name)